@@ -1,3 +1,6 @@
+from functools import lru_cache
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from app.utils.logger import get_logger
 
@@ -8,8 +11,64 @@ class Settings(BaseSettings):
     API_URL: str
     API_KEY: str
     MEDIA_ROOT: str = "./media"
+    # 服务内部数据（批量任务进度、感知哈希索引等）的目录，不能位于 MEDIA_ROOT 之下，否则会被 /media 公开
+    DATA_DIR: str = "./data"
     PUBLIC_BASE_URL: str = ""
 
+    # 上游连接池大小（同一 host 复用的连接数）
+    HTTP_POOL_MAXSIZE: int = 20
+    # 启动预热时建立的上游连接数，0 表示不预热
+    HTTP_PREWARM_CONNECTIONS: int = 2
+    HTTP_PREWARM_TIMEOUT: float = 5.0
+
+    # 生成任务调度：全局并发、批量任务并发、单租户并发上限，以及租户权重（JSON，如 {"shop-a": 3}）
+    SCHED_MAX_CONCURRENCY: int = 8
+    SCHED_BATCH_MAX_CONCURRENCY: int = 6
+    SCHED_TENANT_MAX_CONCURRENCY: int = 4
+    SCHED_TENANT_WEIGHTS: dict[str, float] = {}
+
+    # 请求截止时间（秒）：默认值与 X-Request-Timeout 请求头允许的上限；断开检测间隔
+    REQUEST_TIMEOUT_SECONDS: float = 180.0
+    REQUEST_TIMEOUT_MAX_SECONDS: float = 600.0
+    DISCONNECT_POLL_INTERVAL: float = 0.5
+
+    # 结果轮询：单个任务最多轮询次数、最小间隔、每个功能保留的历史耗时样本数、启用自适应所需样本数
+    POLL_MAX_REQUESTS: int = 40
+    POLL_MIN_INTERVAL: float = 0.5
+    POLL_HISTORY_SIZE: int = 200
+    POLL_MIN_SAMPLES: int = 5
+
+    # 批量导入：单个批量任务同时运行的生成数
+    BULK_CONCURRENCY: int = 4
+
+    # 近似重复检测：是否启用、整组图片允许的最大汉明距离（每张 64 位）、单张图片允许的最大汉明距离、
+    # 4x4 色块任一通道允许的最大颜色差（0~255）、索引文件（默认 MEDIA_ROOT/phash_index.jsonl）
+    PHASH_ENABLED: bool = True
+    PHASH_MAX_DISTANCE: int = 12
+    PHASH_MAX_IMAGE_DISTANCE: int = 6
+    PHASH_MAX_COLOR_DIFF: int = 24
+    PHASH_INDEX_PATH: str = ""
+
+    # CPU 密集型步骤（base64 编码、哈希）的执行器：thread 或 process；工作者数量，0 表示 CPU 核数
+    CPU_EXECUTOR: Literal["thread", "process"] = "thread"
+    CPU_WORKERS: int = 0
+
+    # 生成分辨率：默认值与按功能单独配置（键为接口路径名或中文功能名）
+    DEFAULT_RESOLUTION: str = "1k"
+    FEATURE_RESOLUTIONS: dict[str, str] = {}
+    # 渐进生成：允许预览的功能列表（JSON 数组）与预览分辨率（须低于该功能的完整分辨率，否则跳过预览）
+    PREVIEW_FEATURES: list[str] = []
+    PREVIEW_RESOLUTION: str = "1k"
+
+    # Idempotency-Key：已完成请求的结果保留时长（秒）
+    IDEMPOTENCY_TTL_SECONDS: float = 86400.0
+
+    # 诊断：访问 /diagnostics/* 所需的令牌（为空时诊断接口关闭）；内存采样的初始开关、采样率、每阶段记录的分配位置数
+    DIAGNOSTICS_TOKEN: str = ""
+    MEMPROF_ENABLED: bool = False
+    MEMPROF_SAMPLE_RATE: float = 0.1
+    MEMPROF_TOP_N: int = 10
+
     model_config = SettingsConfigDict(
         env_file=".env",
         case_sensitive=True,
@@ -17,13 +76,25 @@ class Settings(BaseSettings):
     )
 
 
-logger.info("开始加载应用配置...")
-try:
-    settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """首次调用时加载配置，之后复用同一实例"""
+    logger.info("开始加载应用配置...")
+    try:
+        s = Settings()
+    except Exception as e:
+        logger.error(f"配置加载失败: {e}")
+        raise
     logger.info("配置加载成功")
-    logger.info(f"API_URL: {settings.API_URL}")
-    logger.info(f"MEDIA_ROOT: {settings.MEDIA_ROOT}")
-    logger.info(f"PUBLIC_BASE_URL: {settings.PUBLIC_BASE_URL}")
-except Exception as e:
-    logger.error(f"配置加载失败: {e}")
-    raise
\ No newline at end of file
+    logger.info(f"API_URL: {s.API_URL}")
+    logger.info(f"MEDIA_ROOT: {s.MEDIA_ROOT}")
+    logger.info(f"DATA_DIR: {s.DATA_DIR}")
+    logger.info(f"PUBLIC_BASE_URL: {s.PUBLIC_BASE_URL}")
+    return s
+
+
+def __getattr__(name: str):
+    # 兼容 `from app.config import settings`：访问时才加载
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,17 +1,58 @@
+import asyncio
+import hmac
+import json
 import os
+import zipfile
+from contextlib import asynccontextmanager
 from pathlib import Path
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
+from app.config import get_settings
+from app.utils.http import prewarm_upstream
 from app.utils.logger import get_logger
+from app.utils.executor import executor_report, monitor_loop_lag, run_cpu_on_buffer, shutdown_cpu_executor
+from app.utils.memprof import get_memory_profiler
 
 # 核心服务
-from app.services.MCPP_fork_main import run as main_run, ServiceError
+from app.services.MCPP_fork_main import run as main_run, ServiceError, load_reference_assets
+from app.services.scheduler import get_scheduler, resolve_tenant
+from app.services.phash_index import get_phash_index
+from app.services.idempotency import (
+    MAX_KEY_LENGTH,
+    IdempotencyConflict,
+    content_digest,
+    fingerprint_request,
+    get_idempotency_store,
+)
+from app.services.bulk import iter_bulk_results, new_job_id, resolve_features, scan_archive
+from app.utils.deadline import Deadline, DeadlineCancelled, DeadlineExceeded, ClientDisconnected, run_with_deadline
 
 logger = get_logger("main")
 
-app = FastAPI(title="Image Generator API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动阶段：加载配置 -> 加载参考图像 -> 预热上游连接 -> 标记就绪"""
+    app.state.ready = False
+    get_settings()
+    loaded = load_reference_assets()
+    logger.info(f"参考图像预加载完成: {loaded} 张")
+    if get_settings().PHASH_ENABLED:
+        await asyncio.to_thread(get_phash_index)
+    await asyncio.to_thread(prewarm_upstream)
+    lag_monitor = asyncio.create_task(monitor_loop_lag())
+    app.state.ready = True
+    logger.info("服务已就绪")
+    yield
+    app.state.ready = False
+    lag_monitor.cancel()
+    shutdown_cpu_executor()
+
+
+app = FastAPI(title="Image Generator API", lifespan=lifespan)
 
 # 挂载 /media：让保存到 MEDIA_ROOT 的图片可以被 URL 访问到
 MEDIA_ROOT = os.getenv("MEDIA_ROOT", "./media")
@@ -40,11 +81,172 @@ def collect_images(image1: UploadFile, image2: UploadFile, image3: UploadFile, i
     }
 
 
+class BufferedUpload:
+    """已读入内存的上传图片，提供 run() 需要的 read/close/filename 接口"""
+
+    def __init__(self, filename: str | None, content: bytes):
+        self.filename = filename
+        self._content = content
+
+    async def read(self) -> bytes:
+        return self._content
+
+    async def close(self) -> None:
+        pass
+
+
+async def buffer_uploads(feature: str, images: dict) -> tuple[str, dict]:
+    """
+    读取上传内容并计算指纹，返回 (指纹, 内存中的图片)
+
+    上传文件在请求结束时会被关闭，而幂等请求的生成任务可能比请求活得更久，因此先读入内存
+    """
+    items = []
+    buffered = {}
+    for field, upload_file in images.items():
+        content = await upload_file.read()
+        await upload_file.close()
+        digest = await run_cpu_on_buffer(content_digest, content)
+        items.append((field, upload_file.filename, digest))
+        buffered[field] = BufferedUpload(upload_file.filename, content)
+    return fingerprint_request(feature, items), buffered
+
+
+def http_error(e: Exception) -> HTTPException | None:
+    """把排队/超时/幂等相关异常转换为 HTTP 错误；其他异常返回 None 交给端点处理"""
+    if isinstance(e, IdempotencyConflict):
+        return HTTPException(status_code=422, detail=str(e))
+    if isinstance(e, DeadlineExceeded):
+        return HTTPException(status_code=504, detail=str(e))
+    if isinstance(e, (ClientDisconnected, DeadlineCancelled)):
+        # 客户端已不在，状态码仅用于日志
+        return HTTPException(status_code=499, detail=str(e))
+    return None
+
+
+async def scheduled_run(images: dict, request: Request, feature: str, progressive: bool = False):
+    """
+    经公平调度器排队后执行生成；超时或客户端断开时取消排队和处理
+
+    progressive 为真时返回 NDJSON 流：先输出预览（如果该功能启用了预览），再输出最终结果
+    """
+    tenant, priority = resolve_tenant(request)
+    deadline = Deadline.from_request(request)
+    idempotency_key = (request.headers.get("idempotency-key") or "").strip()
+    if len(idempotency_key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key 过长")
+    previews: asyncio.Queue = asyncio.Queue()
+
+    async def _generate(images: dict, run_deadline: Deadline) -> dict:
+        async with get_scheduler().slot(tenant, priority):
+            return await main_run(
+                images, request=request, feature=feature, deadline=run_deadline,
+                on_preview=previews.put_nowait if progressive else None, tenant=tenant,
+            )
+
+    async def _work() -> dict:
+        if not idempotency_key:
+            return await _generate(images, deadline)
+        fingerprint, buffered = await buffer_uploads(feature, images)
+        # 生成任务由幂等记录持有，使用独立的截止时间：客户端断开只结束本次等待，
+        # 生成继续进行，重试可以拿到结果；只有超时才取消生成
+        run_deadline = Deadline(deadline.remaining())
+        # 按租户隔离 key，避免不同调用方互相命中
+        return await get_idempotency_store().run(
+            f"{tenant}:{idempotency_key}",
+            fingerprint,
+            lambda: run_with_deadline(_generate(buffered, run_deadline), run_deadline),
+        )
+
+    if progressive:
+        task = asyncio.create_task(run_with_deadline(_work(), deadline, request=request))
+        return StreamingResponse(progressive_stream(task, previews, feature), media_type="application/x-ndjson")
+
+    try:
+        return await run_with_deadline(_work(), deadline, request=request)
+    except (IdempotencyConflict, DeadlineExceeded, ClientDisconnected, DeadlineCancelled) as e:
+        raise http_error(e)
+
+
+async def progressive_stream(task: asyncio.Task, previews: asyncio.Queue, feature: str):
+    """预览先到先发；最终结果（或错误）作为最后一行"""
+    try:
+        while True:
+            getter = asyncio.ensure_future(previews.get())
+            done, _ = await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield json.dumps(getter.result(), ensure_ascii=False) + "\n"
+                continue
+            getter.cancel()
+            try:
+                line = task.result()
+            except ServiceError as e:
+                logger.error(f"{feature}生成失败: {str(e)}")
+                line = {"status": "error", "code": 400, "detail": str(e)}
+            except Exception as e:
+                err = http_error(e)
+                if err is None:
+                    logger.exception(f"{feature} progressive generation crashed")
+                    err = HTTPException(status_code=500, detail="Internal server error")
+                line = {"status": "error", "code": err.status_code, "detail": err.detail}
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+            return
+    finally:
+        if not task.done():
+            task.cancel()
+
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
 
+@app.get("/ready")
+async def ready(request: Request):
+    # 启动预热完成前返回 503，供负载均衡/滚动发布判断是否切流量
+    if not getattr(request.app.state, "ready", False):
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ready"}
+
+
+def require_diagnostics(request: Request) -> None:
+    """诊断接口需在 X-Diagnostics-Token 中携带 DIAGNOSTICS_TOKEN；未配置令牌时接口不可用"""
+    token = get_settings().DIAGNOSTICS_TOKEN
+    if not token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    provided = request.headers.get("x-diagnostics-token") or ""
+    if not hmac.compare_digest(provided.encode(), token.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.get("/diagnostics/memory")
+async def diagnostics_memory(request: Request, recent: int = 10):
+    require_diagnostics(request)
+    return get_memory_profiler().report(recent=recent)
+
+
+@app.get("/diagnostics/executor")
+async def diagnostics_executor(request: Request):
+    require_diagnostics(request)
+    return executor_report()
+
+
+@app.post("/diagnostics/memory")
+async def configure_memory_profiling(
+    request: Request,
+    enabled: bool | None = None,
+    sample_rate: float | None = None,
+    top_n: int | None = None,
+    reset: bool = False,
+):
+    require_diagnostics(request)
+    profiler = get_memory_profiler()
+    profiler.configure(enabled=enabled, sample_rate=sample_rate, top_n=top_n)
+    if reset:
+        profiler.reset()
+    return {"enabled": profiler.enabled, "sample_rate": profiler.sample_rate, "top_n": profiler.top_n}
+
+
 # 商品主图生成端点
 @app.post("/generate/product_main")
 async def generate_product_main(
@@ -53,13 +255,16 @@ async def generate_product_main(
     image2: UploadFile = File(..., description="6寸餐盘图像"),
     image3: UploadFile = File(..., description="9寸餐盘图像"),
     image4: UploadFile = File(..., description="刀叉图像"),
+    progressive: bool = Query(False, description="先返回低分辨率预览，再返回最终结果（NDJSON 流）"),
 ):
     logger.info("接收到商品主图生成请求")
     images = collect_images(image1, image2, image3, image4)
     try:
-        result = await main_run(images, request=request, feature="商品主图")
+        result = await scheduled_run(images, request=request, feature="商品主图", progressive=progressive)
         logger.info("商品主图生成请求处理成功")
         return result
+    except HTTPException:
+        raise
     except ServiceError as e:
         logger.error(f"商品主图生成失败: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -75,13 +280,16 @@ async def generate_product_display_1(
     image2: UploadFile = File(..., description="6寸餐盘图像"),
     image3: UploadFile = File(..., description="9寸餐盘图像"),
     image4: UploadFile = File(..., description="刀叉图像"),
+    progressive: bool = Query(False, description="先返回低分辨率预览，再返回最终结果（NDJSON 流）"),
 ):
     logger.info("接收到商品展示图1生成请求")
     images = collect_images(image1, image2, image3, image4)
     try:
-        result = await main_run(images, request=request, feature="商品展示图1")
+        result = await scheduled_run(images, request=request, feature="商品展示图1", progressive=progressive)
         logger.info("商品展示图1生成请求处理成功")
         return result
+    except HTTPException:
+        raise
     except ServiceError as e:
         logger.error(f"商品展示图1生成失败: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -97,14 +305,17 @@ async def generate_product_size(
     image2: UploadFile = File(..., description="6寸餐盘图像"),
     image3: UploadFile = File(..., description="9寸餐盘图像"),
     image4: UploadFile = File(..., description="刀叉图像"),
+    progressive: bool = Query(False, description="先返回低分辨率预览，再返回最终结果（NDJSON 流）"),
 ):
     logger.info("接收到商品尺寸图生成请求")
     # 收集基本图像
     images = collect_images(image1, image2, image3, image4)
     try:
-        result = await main_run(images, request=request, feature="商品尺寸图")
+        result = await scheduled_run(images, request=request, feature="商品尺寸图", progressive=progressive)
         logger.info("商品尺寸图生成请求处理成功")
         return result
+    except HTTPException:
+        raise
     except ServiceError as e:
         logger.error(f"商品尺寸图生成失败: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -120,13 +331,16 @@ async def generate_product_display_2(
     image2: UploadFile = File(..., description="6寸餐盘图像"),
     image3: UploadFile = File(..., description="9寸餐盘图像"),
     image4: UploadFile = File(..., description="刀叉图像"),
+    progressive: bool = Query(False, description="先返回低分辨率预览，再返回最终结果（NDJSON 流）"),
 ):
     logger.info("接收到商品展示图2生成请求")
     images = collect_images(image1, image2, image3, image4)
     try:
-        result = await main_run(images, request=request, feature="商品展示图2")
+        result = await scheduled_run(images, request=request, feature="商品展示图2", progressive=progressive)
         logger.info("商品展示图2生成请求处理成功")
         return result
+    except HTTPException:
+        raise
     except ServiceError as e:
         logger.error(f"商品展示图2生成失败: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -142,13 +356,16 @@ async def generate_scene_display_1(
     image2: UploadFile = File(..., description="6寸餐盘图像"),
     image3: UploadFile = File(..., description="9寸餐盘图像"),
     image4: UploadFile = File(..., description="刀叉图像"),
+    progressive: bool = Query(False, description="先返回低分辨率预览，再返回最终结果（NDJSON 流）"),
 ):
     logger.info("接收到场景展示图1生成请求")
     images = collect_images(image1, image2, image3, image4)
     try:
-        result = await main_run(images, request=request, feature="场景展示图1")
+        result = await scheduled_run(images, request=request, feature="场景展示图1", progressive=progressive)
         logger.info("场景展示图1生成请求处理成功")
         return result
+    except HTTPException:
+        raise
     except ServiceError as e:
         logger.error(f"场景展示图1生成失败: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -164,16 +381,53 @@ async def generate_scene_display_2(
     image2: UploadFile = File(..., description="6寸餐盘图像"),
     image3: UploadFile = File(..., description="9寸餐盘图像"),
     image4: UploadFile = File(..., description="刀叉图像"),
+    progressive: bool = Query(False, description="先返回低分辨率预览，再返回最终结果（NDJSON 流）"),
 ):
     logger.info("接收到场景展示图2生成请求")
     images = collect_images(image1, image2, image3, image4)
     try:
-        result = await main_run(images, request=request, feature="场景展示图2")
+        result = await scheduled_run(images, request=request, feature="场景展示图2", progressive=progressive)
         logger.info("场景展示图2生成请求处理成功")
         return result
+    except HTTPException:
+        raise
     except ServiceError as e:
         logger.error(f"场景展示图2生成失败: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
     except Exception:
         logger.exception("generate_scene_display_2 crashed")
-        raise HTTPException(status_code=500, detail="Internal server error")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+
+# 批量生成端点：上传 ZIP（每个目录一组图片或 manifest.jsonl），以 NDJSON 流式返回结果
+@app.post("/generate/bulk")
+async def generate_bulk(
+    request: Request,
+    archive: UploadFile = File(..., description="包含多组图片的 ZIP 压缩包"),
+    features: str = Form(..., description="逗号分隔的功能，如 product_main,scene_display_1"),
+    job_id: str | None = Form(None, description="批量任务 ID，重复提交同一 ID 时跳过已成功的部分"),
+):
+    logger.info("接收到批量生成请求")
+    try:
+        feature_list = resolve_features(features)
+        job = new_job_id(job_id)
+        # 上传文件由 Starlette 缓存在临时文件中，zipfile 按需读取成员，不整体解压
+        zf = zipfile.ZipFile(archive.file)
+        sets = scan_archive(zf)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="archive 不是有效的 ZIP 文件")
+    except ServiceError as e:
+        logger.error(f"批量生成请求无效: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+    tenant, _ = resolve_tenant(request)
+
+    async def _stream():
+        yield json.dumps({"job_id": job, "sets": len(sets), "features": feature_list}, ensure_ascii=False) + "\n"
+        try:
+            async for line in iter_bulk_results(zf, sets, feature_list, job, tenant=tenant):
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+        finally:
+            zf.close()
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
@@ -1,18 +1,130 @@
+import asyncio
 import base64
 import io
 import os
-from app.utils.http import post_edit, wait_for_outputs
+import time
+from typing import Callable
+
+from app.services.phash_index import HASH_BITS, combine_signatures, get_phash_index, image_signature
+from app.services.scheduler import BATCH, get_scheduler, resolve_tenant
+from app.utils.deadline import Deadline, DeadlineCancelled, DeadlineExceeded
+from app.utils.http import APIRequestError, cancel_task, post_edit, wait_for_outputs
+from app.utils.executor import run_cpu_on_buffer
 from app.utils.logger import get_logger
-from app.config import settings
+from app.utils.memprof import NULL_PROFILE, get_memory_profiler
+from app.utils.polling import get_completion_stats, plan_polls, reported_duration
+from app.config import get_settings
 from app.prompts import get_prompt  # 导入新的提示词获取函数
 
 logger = get_logger("MCPP_main")
 
+# 接口路径名 -> 功能名称（与 /generate/* 端点一一对应）
+FEATURES = {
+    "product_main": "商品主图",
+    "product_display_1": "商品展示图1",
+    "product_size": "商品尺寸图",
+    "product_display_2": "商品展示图2",
+    "scene_display_1": "场景展示图1",
+    "scene_display_2": "场景展示图2",
+}
+
+# 各功能对应的固定参考图像（位于 app/input 下）
+REFERENCE_FILES = {
+    "商品尺寸图": "reference_size.jpg",
+    "商品主图": "reference_main1.jpg",
+}
+
+def _feature_matches(feature: str, names) -> bool:
+    # 配置中既可以写接口路径名，也可以写中文功能名
+    route = next((k for k, v in FEATURES.items() if v == feature), None)
+    return feature in names or (route is not None and route in names)
+
+
+def feature_resolution(feature: str) -> str:
+    """完整生成使用的分辨率：FEATURE_RESOLUTIONS 中的单独配置，否则 DEFAULT_RESOLUTION"""
+    settings = get_settings()
+    for name, resolution in settings.FEATURE_RESOLUTIONS.items():
+        if _feature_matches(feature, (name,)):
+            return resolution
+    return settings.DEFAULT_RESOLUTION
+
+
+def _resolution_pixels(resolution: str) -> float | None:
+    """把 "1k"、"2K"、"512" 这样的分辨率换算成像素数，无法识别时返回 None"""
+    value = (resolution or "").strip().lower()
+    try:
+        if value.endswith("k"):
+            return float(value[:-1]) * 1000
+        return float(value)
+    except ValueError:
+        return None
+
+
+# 已提示过预览被跳过的 (功能, 预览分辨率, 完整分辨率)，避免每个请求都打印警告
+_preview_skip_warned: set[tuple[str, str, str]] = set()
+
+
+def preview_enabled(feature: str) -> bool:
+    """功能在 PREVIEW_FEATURES 中，且预览分辨率确实低于完整分辨率"""
+    settings = get_settings()
+    if not _feature_matches(feature, settings.PREVIEW_FEATURES):
+        return False
+    preview, full = settings.PREVIEW_RESOLUTION, feature_resolution(feature)
+    preview_px, full_px = _resolution_pixels(preview), _resolution_pixels(full)
+    if preview_px is not None and full_px is not None and preview_px < full_px:
+        return True
+    # 预览不比完整生成便宜或更快，只会让上游开销翻倍
+    key = (feature, preview, full)
+    if key not in _preview_skip_warned:
+        _preview_skip_warned.add(key)
+        logger.warning(f"{feature} 的预览分辨率 {preview} 不低于完整分辨率 {full}，跳过预览")
+    return False
+
+
+# feature -> 参考图像的 data URL，启动时预加载
+_reference_cache: dict[str, str] = {}
+
 
 class ServiceError(Exception):
     pass
 
 
+class TransientServiceError(ServiceError):
+    """上游暂时失败（5xx、网络错误、返回异常）或内部错误：对外同样返回 400，但重试可能成功，不作为幂等最终结果保存"""
+
+
+def _load_reference(feature: str) -> str | None:
+    """读取参考图像并编码为 data URL，结果缓存"""
+    if feature in _reference_cache:
+        return _reference_cache[feature]
+
+    filename = REFERENCE_FILES.get(feature)
+    if not filename:
+        return None
+    reference_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "input", filename)
+    if not os.path.exists(reference_file_path):
+        return None
+
+    try:
+        with open(reference_file_path, 'rb') as f:
+            content = f.read()
+        base64_str = base64.b64encode(content).decode('utf-8')
+        ext = reference_file_path.split('.')[-1].lower()
+        base64_url = f"data:image/{ext};base64,{base64_str}"
+    except Exception as e:
+        logger.error(f"加载参考图像失败: {e}")
+        return None
+
+    _reference_cache[feature] = base64_url
+    logger.info(f"加载了参考图像: {reference_file_path}")
+    return base64_url
+
+
+def load_reference_assets() -> int:
+    """预加载所有参考图像，返回成功加载的数量"""
+    return sum(1 for feature in REFERENCE_FILES if _load_reference(feature))
+
+
 def _normalize_images(images) -> list[str]:
     """标准化图像输入格式"""
     if isinstance(images, list):
@@ -32,9 +144,60 @@ def _normalize_images(images) -> list[str]:
     return []
 
 
-async def run(images, request=None, feature="combine_images"):
+# base64 分块编码的块大小：3 的倍数，各块结果直接拼接即为整体编码
+ENCODE_CHUNK_BYTES = 768 * 1024
+
+
+def _encode_data_url(content, ext: str) -> str:
+    """
+    把图片内容编码为 data URL（在 CPU 执行器中运行，content 可以是 memoryview）
+
+    b64encode 在整个调用期间持有 GIL，分块编码让线程池模式下事件循环线程能在块之间拿回 GIL
+    """
+    view = memoryview(content)
+    parts = [f"data:image/{ext};base64,"]
+    for start in range(0, len(view), ENCODE_CHUNK_BYTES):
+        parts.append(base64.b64encode(view[start:start + ENCODE_CHUNK_BYTES]).decode('ascii'))
+    return "".join(parts)
+
+
+def _remember(scope: tuple, signature: tuple[int, bytes] | None, bits: int, output: str) -> None:
+    """把本次输入的感知签名和生成结果加入索引"""
+    if signature is None:
+        return
+    try:
+        get_phash_index().add(scope, signature[0], bits, signature[1], output)
+    except Exception as e:
+        logger.warning(f"记录感知哈希失败: {e}")
+
+
+async def run(
+    images,
+    request=None,
+    feature="combine_images",
+    deadline: Deadline | None = None,
+    on_preview: Callable[[dict], None] | None = None,
+    tenant: str | None = None,
+):
     logger.info("MCPP_main start")
-    
+    if deadline is None:
+        deadline = Deadline.from_request(request)
+    if tenant is None:
+        tenant, _ = resolve_tenant(request)
+
+    # 诊断模式下按采样率记录各阶段的内存峰值
+    profile = get_memory_profiler().start(feature)
+    error = True
+    try:
+        await profile.begin()
+        result = await _run(images, feature, deadline, profile, on_preview, tenant)
+        error = False
+        return result
+    finally:
+        profile.finish(error=error)
+
+
+async def _run(images, feature: str, deadline: Deadline, profile, on_preview=None, tenant: str = "anonymous") -> dict:
     # 直接使用Python函数获取提示词
     prompt = get_prompt(feature)
     
@@ -48,91 +211,223 @@ async def run(images, request=None, feature="combine_images"):
     image_base64_list = []
     
     # 根据不同功能加载对应的固定参考图像
-    if feature == "商品尺寸图":
-        reference_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "input", "reference_size.jpg")
-    elif feature == "商品主图":
-        reference_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "input", "reference_main1.jpg")
-    else:
-        reference_file_path = None
-    
-    if reference_file_path and os.path.exists(reference_file_path):
-        try:
-            with open(reference_file_path, 'rb') as f:
-                content = f.read()
-                base64_str = base64.b64encode(content).decode('utf-8')
-                ext = reference_file_path.split('.')[-1].lower()
-                base64_url = f"data:image/{ext};base64,{base64_str}"
-                image_base64_list.append(base64_url)
-            logger.info(f"加载了参考图像: {reference_file_path}")
-        except Exception as e:
-            logger.error(f"加载参考图像失败: {e}")
+    reference_url = _load_reference(feature)
+    if reference_url:
+        image_base64_list.append(reference_url)
     
     # 处理上传的图像
-    for key, upload_file in images.items():
-        # 读取文件内容
-        content = await upload_file.read()
-        # 转换为base64编码
-        base64_str = base64.b64encode(content).decode('utf-8')
-        # 获取文件扩展名
-        ext = upload_file.filename.split('.')[-1].lower() if upload_file.filename else 'png'
-        # 构建base64字符串
-        base64_url = f"data:image/{ext};base64,{base64_str}"
-        image_base64_list.append(base64_url)
-        # 关闭文件
-        await upload_file.close()
+    contents = []
+    with profile.stage("read_uploads"):
+        for key, upload_file in images.items():
+            # 每张图之间检查是否已取消/超时，尽早释放缓冲
+            deadline.check()
+            # 读取文件内容
+            content = await upload_file.read()
+            # 获取文件扩展名
+            ext = upload_file.filename.split('.')[-1].lower() if upload_file.filename else 'png'
+            contents.append((ext, content))
+            # 关闭文件
+            await upload_file.close()
+
+    # 查找同一租户、功能、分辨率下近似重复的历史输入，命中则直接复用之前的生成结果
+    settings = get_settings()
+    resolution = feature_resolution(feature)
+    scope = (tenant, feature, resolution)
+    signature = None
+    bits = HASH_BITS * len(contents)
+    if settings.PHASH_ENABLED and contents:
+        with profile.stage("phash_lookup"):
+            signatures = await asyncio.gather(*(run_cpu_on_buffer(image_signature, c) for _, c in contents))
+            signature = combine_signatures(signatures)
+            match = get_phash_index().lookup(scope, signature[0], bits, signature[1]) if signature else None
+        if match is not None:
+            output, distance = match
+            logger.info(f"MCPP_main 命中近似重复输入 (距离 {distance}/{bits})，复用已有结果")
+            return {
+                "status": "success",
+                "output": output,
+                "mode": "cache",
+                "distance": distance,
+                "similarity": round(1 - distance / bits, 4),
+            }
+
+    # base64 编码在 CPU 执行器中并行完成，不占用事件循环
+    with profile.stage("encode"):
+        image_base64_list.extend(
+            await asyncio.gather(*(run_cpu_on_buffer(_encode_data_url, c, ext) for ext, c in contents))
+        )
+    # 此时上传内容与编码结果同时存活，是单个请求内存占用最高的时刻
+    await profile.capture("encode")
+
+    if not image_base64_list:
+        raise ServiceError("缺少图片数据：必须上传至少一张图片")
+
+    full = _generate(
+        prompt, image_base64_list, feature, resolution, deadline, profile,
+        on_done=lambda output: _remember(scope, signature, bits, output),
+    )
+    # 渐进模式：同时发起一个低分辨率预览，先完成的预览通过 on_preview 回调交给调用方
+    preview_task = None
+    preview_deadline = None
+    if on_preview is not None and preview_enabled(feature):
+        preview_deadline = Deadline(deadline.remaining())
+        preview_task = asyncio.create_task(_run_preview(
+            prompt, image_base64_list, feature, preview_deadline, on_preview, tenant,
+        ))
+    # 编码结果只由生成协程持有，上游请求发出后即可释放
+    del image_base64_list, contents
 
     try:
-        if not image_base64_list:
-            raise ServiceError("缺少图片数据：必须上传至少一张图片")
+        return await full
+    finally:
+        if preview_task is not None and not preview_task.done():
+            preview_deadline.cancel()
+            preview_task.cancel()
+
 
+async def _run_preview(
+    prompt: str, image_urls: list[str], feature: str, deadline: Deadline, on_preview, tenant: str,
+) -> None:
+    # 预览是一次额外的上游调用，单独占用该租户的一个批量槽位；没有空闲槽位时直接放弃，不排队
+    with get_scheduler().try_slot(tenant, BATCH) as acquired:
+        if not acquired:
+            logger.info(f"MCPP_main 调度器无空闲槽位，跳过 {feature} 预览")
+            return
+        try:
+            result = await _generate(
+                prompt, image_urls, feature, get_settings().PREVIEW_RESOLUTION, deadline, NULL_PROFILE,
+                stats_key=f"{feature}:preview",
+            )
+        except (ServiceError, DeadlineExceeded, DeadlineCancelled) as e:
+            logger.warning(f"MCPP_main 预览生成失败: {e}")
+            return
+    logger.info("MCPP_main preview ready")
+    on_preview({**result, "status": "preview"})
+
+
+async def _generate(
+    prompt: str,
+    image_urls: list[str],
+    feature: str,
+    resolution: str,
+    deadline: Deadline,
+    profile,
+    stats_key: str | None = None,
+    on_done=None,
+) -> dict:
+    """提交一次上游生成并等待结果；stats_key 为完成耗时的统计维度（默认按功能）"""
+    settings = get_settings()
+    stats = get_completion_stats()
+    stats_key = stats_key or feature
+    try:
         payload = {
             "prompt": prompt,
-            "images": image_base64_list,
+            "images": image_urls,
             "enable_sync_mode": True,
             "enable_base64_output": False,
-            "resolution": "1k",
+            "resolution": resolution,
         }
+        del image_urls
 
-        result = post_edit(
-            api_url=settings.API_URL,
-            api_key=settings.API_KEY,
-            payload=payload,
-        )
+        deadline.check()
+        submitted_at = time.monotonic()
+        # 阻塞的上游调用放到线程中执行，避免卡住事件循环
+        with profile.stage("upstream_submit"):
+            result = await asyncio.to_thread(
+                post_edit,
+                api_url=settings.API_URL,
+                api_key=settings.API_KEY,
+                payload=payload,
+                timeout=max(1, min(180, int(deadline.remaining()) + 1)),
+            )
+            # 上游请求发出后就不再需要编码后的图片
+            del payload
 
         data = result.get("data") if isinstance(result, dict) else None
         if not isinstance(data, dict):
             logger.error("MCPP_main invalid response: %s", result)
-            raise ServiceError("上游返回格式异常")
+            raise TransientServiceError("上游返回格式异常")
 
         status = (data.get("status") or "").lower()
         outputs = data.get("outputs") or []
 
         if outputs:
+            stats.record(stats_key, time.monotonic() - submitted_at)
+            if on_done is not None:
+                on_done(outputs[0])
             logger.info("MCPP_main success (sync)")
             return {"status": "success", "output": outputs[0], "mode": "sync"}
 
-        result_url = (data.get("urls") or {}).get("get")
+        urls = data.get("urls") or {}
+        result_url = urls.get("get")
         if not result_url:
             logger.error("MCPP_main no outputs and no result url: %s", result)
-            raise ServiceError("模型未返回结果且缺少结果查询地址")
+            raise TransientServiceError("模型未返回结果且缺少结果查询地址")
 
-        final = wait_for_outputs(
-            result_url=result_url,
-            api_key=settings.API_KEY,
-            timeout_seconds=180,
-            poll_interval=1.0,
+        # 按历史完成时间规划轮询点（相对提交时刻），换算为相对轮询开始
+        elapsed = time.monotonic() - submitted_at
+        timeout_seconds = min(180, deadline.remaining())
+        offsets = plan_polls(
+            stats,
+            stats_key,
+            timeout_seconds=elapsed + timeout_seconds,
+            budget=settings.POLL_MAX_REQUESTS,
+            min_interval=settings.POLL_MIN_INTERVAL,
+            fallback_interval=1.0,
+            min_samples=settings.POLL_MIN_SAMPLES,
         )
+        schedule = [max(t - elapsed, 0.0) for t in offsets if t > elapsed] or [0.0]
+
+        try:
+            deadline.check()
+            # 轮询不单独统计内存：阶段可能长达数分钟，峰值主要来自同时在处理的其他请求
+            final = await asyncio.to_thread(
+                wait_for_outputs,
+                result_url=result_url,
+                api_key=settings.API_KEY,
+                timeout_seconds=timeout_seconds,
+                cancel_event=deadline.event,
+                schedule=schedule,
+            )
+        except BaseException:
+            if not (deadline.cancelled or deadline.expired):
+                raise
+            # 已取消或超时：停止线程中的轮询，并在上游支持时取消任务（不阻塞当前取消流程）
+            deadline.cancel()
+            if urls.get("cancel"):
+                asyncio.get_running_loop().run_in_executor(
+                    None, cancel_task, urls["cancel"], settings.API_KEY
+                )
+            raise
         fdata = final.get("data") if isinstance(final, dict) else None
         foutputs = (fdata or {}).get("outputs") or []
         if not foutputs:
             logger.error("MCPP_main async done but still no outputs: %s", final)
-            raise ServiceError("模型未返回结果")
+            raise TransientServiceError("模型未返回结果")
 
+        # 观测值受轮询点限制，只会晚于真实完成时间；上游报告了耗时则取较小者
+        observed = time.monotonic() - submitted_at
+        reported = reported_duration(fdata)
+        stats.record(stats_key, observed if reported is None else min(observed, reported))
+        if on_done is not None:
+            on_done(foutputs[0])
         logger.info("MCPP_main success (async fallback)")
         return {"status": "success", "output": foutputs[0], "mode": "async"}
 
-    except ServiceError:
+    except (ServiceError, DeadlineExceeded, DeadlineCancelled):
         raise
+    except APIRequestError as e:
+        if deadline.expired:
+            # 轮询在截止时刻用尽预算，按超时处理而不是内部错误
+            raise DeadlineExceeded(f"request exceeded {deadline.timeout_seconds:.1f}s deadline")
+        if e.status_code is not None and 400 <= e.status_code < 500 and e.status_code not in (408, 429):
+            # 上游拒绝了请求内容，重试同样会失败
+            logger.warning(f"MCPP_main upstream rejected request ({e.status_code})")
+            raise ServiceError(f"上游拒绝请求 ({e.status_code})") from None
+        logger.exception("MCPP_main upstream request failed")
+        raise TransientServiceError("MCPP_main internal error") from None
     except Exception:
+        if deadline.expired:
+            raise DeadlineExceeded(f"request exceeded {deadline.timeout_seconds:.1f}s deadline")
         logger.exception("MCPP_main crashed")
-        raise ServiceError("MCPP_main internal error")
\ No newline at end of file
+        raise TransientServiceError("MCPP_main internal error") from None
@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import re
+import uuid
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import Any, AsyncIterator
+
+from app.config import get_settings
+from app.services.MCPP_fork_main import FEATURES, ServiceError, run as main_run
+from app.services.scheduler import BATCH, get_scheduler
+from app.utils.deadline import Deadline, DeadlineExceeded
+from app.utils.executor import run_cpu_in_thread
+from app.utils.logger import get_logger
+
+logger = get_logger("bulk")
+
+# 压缩包内文件名（去掉扩展名）-> run() 使用的图片槽位
+SLOT_ALIASES = {
+    "image1": "image1", "1": "image1", "纸巾": "image1",
+    "image2": "image2", "2": "image2", "6寸餐盘": "image2",
+    "image3": "image3", "3": "image3", "9寸餐盘": "image3",
+    "image4": "image4", "4": "image4", "刀叉": "image4",
+}
+SLOTS = ("image1", "image2", "image3", "image4")
+MANIFEST_NAME = "manifest.jsonl"
+
+_JOB_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class _ArchiveImage:
+    """把压缩包成员包装成 run() 需要的上传文件接口，读取时才解压"""
+
+    def __init__(self, archive: zipfile.ZipFile, member: str, filename: str):
+        self._archive = archive
+        self._member = member
+        self.filename = filename
+
+    async def read(self) -> bytes:
+        # 解压是 CPU 密集的（8 MB 成员约 10 毫秒）；ZipFile 对象无法传给子进程，因此总在线程中执行
+        return await run_cpu_in_thread(self._archive.read, self._member)
+
+    async def close(self) -> None:
+        pass
+
+
+def _display_name(info: zipfile.ZipInfo) -> str:
+    # 未设置 UTF-8 标志的中文文件名通常是 GBK 编码，被 zipfile 按 cp437 解码
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("gbk")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+def resolve_features(raw: str) -> list[str]:
+    """解析逗号分隔的功能列表，接受接口路径名或中文功能名"""
+    names = set(FEATURES.values())
+    features = []
+    for item in (raw or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        feature = FEATURES.get(item) or (item if item in names else None)
+        if feature is None:
+            raise ServiceError(f"未知功能: {item}")
+        if feature not in features:
+            features.append(feature)
+    if not features:
+        raise ServiceError("至少需要指定一个功能")
+    return features
+
+
+def scan_archive(archive: zipfile.ZipFile) -> list[tuple[str, dict[str, str]]]:
+    """
+    列出压缩包中的图片组 [(sku, {槽位: 成员名})]，只读目录不解压
+
+    优先使用根目录的 manifest.jsonl（每行 {"sku": ..., "image1": 成员名, ...}），
+    否则按目录划分：每个目录是一个 SKU，文件名为 image1~4、1~4 或 纸巾/6寸餐盘/9寸餐盘/刀叉
+    """
+    members = {_display_name(info): info.filename for info in archive.infolist() if not info.is_dir()}
+
+    if MANIFEST_NAME in members:
+        sets = []
+        with archive.open(members[MANIFEST_NAME]) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    raise ServiceError(f"manifest 第 {lineno} 行不是合法 JSON")
+                if not isinstance(entry, dict):
+                    raise ServiceError(f"manifest 第 {lineno} 行必须是 JSON 对象")
+                sku = str(entry.get("sku") or "").strip()
+                if not sku:
+                    raise ServiceError(f"manifest 第 {lineno} 行缺少 sku")
+                slots = {}
+                for slot in SLOTS:
+                    name = entry.get(slot)
+                    if not isinstance(name, str) or name not in members:
+                        raise ServiceError(f"manifest 第 {lineno} 行的 {slot} 不存在: {name}")
+                    slots[slot] = members[name]
+                sets.append((sku, slots))
+        return sets
+
+    grouped: dict[str, dict[str, str]] = {}
+    for name in members:
+        path = PurePosixPath(name)
+        slot = SLOT_ALIASES.get(path.stem.lower())
+        if slot is None or len(path.parts) < 2:
+            continue
+        grouped.setdefault(str(path.parent), {})[slot] = members[name]
+
+    sets = []
+    for sku, slots in sorted(grouped.items()):
+        missing = [s for s in SLOTS if s not in slots]
+        if missing:
+            logger.warning(f"SKU {sku} 缺少图片 {missing}，已跳过")
+            continue
+        sets.append((sku, slots))
+    return sets
+
+
+def _state_path(tenant: str, job_id: str) -> Path:
+    # 按租户分目录，不同租户使用相同 job_id 互不影响；目录名取哈希，不暴露租户标识
+    tenant_dir = hashlib.sha256(tenant.encode("utf-8")).hexdigest()[:16]
+    root = Path(get_settings().DATA_DIR) / "bulk" / tenant_dir
+    root.mkdir(parents=True, exist_ok=True)
+    return root / f"{job_id}.jsonl"
+
+
+def _set_digest(archive: zipfile.ZipFile, slots: dict[str, str]) -> str:
+    """一组图片的内容摘要：取自中央目录中各成员的 CRC32 与大小，不需要解压"""
+    h = hashlib.sha256()
+    for slot in SLOTS:
+        info = archive.getinfo(slots[slot])
+        h.update(f"{slot}:{info.CRC:08x}:{info.file_size}\n".encode("ascii"))
+    return h.hexdigest()
+
+
+def _load_done(path: Path) -> dict[tuple[str, str], dict]:
+    """读取已成功的结果 {(sku, 功能): 记录}，记录中带有生成时的图片摘要 digest"""
+    done = {}
+    if not path.exists():
+        return done
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if item.get("status") == "success":
+                done[(item.get("sku"), item.get("feature"))] = item
+    return done
+
+
+def new_job_id(job_id: str | None = None) -> str:
+    if job_id is None or not job_id.strip():
+        return uuid.uuid4().hex
+    job_id = job_id.strip()
+    if not _JOB_ID_RE.match(job_id):
+        raise ServiceError("job_id 只能包含字母、数字、下划线和短横线，且不超过 64 个字符")
+    return job_id
+
+
+async def _generate_one(
+    archive: zipfile.ZipFile,
+    sku: str,
+    slots: dict[str, str],
+    feature: str,
+    tenant: str,
+) -> dict:
+    images = {
+        slot: _ArchiveImage(archive, member, PurePosixPath(member).name)
+        for slot, member in slots.items()
+    }
+    line: dict[str, Any] = {"sku": sku, "feature": feature}
+    try:
+        async with get_scheduler().slot(tenant, BATCH):
+            result = await main_run(images, feature=feature, deadline=Deadline.from_request(None), tenant=tenant)
+        line.update(result)
+    except (ServiceError, DeadlineExceeded) as e:
+        line.update({"status": "error", "detail": str(e)})
+    except Exception:
+        logger.exception(f"批量生成失败: {sku} / {feature}")
+        line.update({"status": "error", "detail": "Internal server error"})
+    return line
+
+
+async def iter_bulk_results(
+    archive: zipfile.ZipFile,
+    sets: list[tuple[str, dict[str, str]]],
+    features: list[str],
+    job_id: str,
+    tenant: str = "anonymous",
+) -> AsyncIterator[dict]:
+    """
+    逐个产出批量生成结果，最多同时运行 BULK_CONCURRENCY 个生成任务
+
+    每条结果追加写入 DATA_DIR/bulk/<租户哈希>/<job_id>.jsonl；同一租户用同一 job_id 重新提交时，
+    图片未变化且已成功的 (sku, 功能) 直接返回记录的结果，只重跑失败、未完成或图片有变化的部分
+    """
+    state = _state_path(tenant, job_id)
+    done = _load_done(state)
+    digests = {sku: _set_digest(archive, slots) for sku, slots in sets}
+    limit = asyncio.Semaphore(max(1, get_settings().BULK_CONCURRENCY))
+    queue: asyncio.Queue = asyncio.Queue()
+    tasks: set[asyncio.Task] = set()
+    logger.info(f"批量任务 {job_id}: {len(sets)} 个 SKU, {len(features)} 个功能, 已完成 {len(done)} 项")
+
+    async def _worker(sku: str, slots: dict[str, str], feature: str) -> None:
+        try:
+            line = await _generate_one(archive, sku, slots, feature, tenant)
+        finally:
+            limit.release()
+        await queue.put(line)
+
+    async def _produce() -> None:
+        try:
+            for sku, slots in sets:
+                for feature in features:
+                    prior = done.get((sku, feature))
+                    if prior is not None and prior.get("digest") == digests[sku]:
+                        await queue.put({**prior, "resumed": True})
+                        continue
+                    await limit.acquire()
+                    task = asyncio.create_task(_worker(sku, slots, feature))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            await asyncio.gather(*list(tasks))
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.create_task(_produce())
+    succeeded = failed = 0
+    try:
+        with state.open("a", encoding="utf-8") as log:
+            while True:
+                line = await queue.get()
+                if line is None:
+                    break
+                if line.get("status") == "success":
+                    succeeded += 1
+                else:
+                    failed += 1
+                if line.get("resumed"):
+                    line.pop("digest", None)
+                else:
+                    log.write(json.dumps({**line, "digest": digests.get(line["sku"])}, ensure_ascii=False) + "\n")
+                    log.flush()
+                yield line
+        await producer
+    finally:
+        for task in [producer, *tasks]:
+            task.cancel()
+
+    logger.info(f"批量任务 {job_id} 完成: 成功 {succeeded}, 失败 {failed}")
+    yield {"job_id": job_id, "status": "done", "succeeded": succeeded, "failed": failed}
@@ -0,0 +1,163 @@
+import asyncio
+import copy
+import hashlib
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Awaitable, Callable
+
+from app.config import get_settings
+from app.services.MCPP_fork_main import ServiceError, TransientServiceError
+from app.utils.logger import get_logger
+
+logger = get_logger("idempotency")
+
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(Exception):
+    """同一 Idempotency-Key 对应了不同的请求内容"""
+
+
+class _Entry:
+    def __init__(self, fingerprint: str, task: asyncio.Task):
+        self.fingerprint = fingerprint
+        # 生成任务由记录持有，不随发起它的请求一起取消；得到最终结果后只保留 result/error，释放任务
+        self.task: asyncio.Task | None = task
+        self.result: dict | None = None
+        self.error: BaseException | None = None
+        self.expires_at: float | None = None
+
+
+def _detach(error: BaseException) -> BaseException:
+    """复制异常且不带 traceback 与 __context__，保存后不会让请求的栈帧（及其中的上传内容）一直存活"""
+    try:
+        return copy.copy(error)
+    except Exception:
+        error.__context__ = error.__cause__ = None
+        return error.with_traceback(None)
+
+
+def _key_label(key: str) -> str:
+    # 日志中只记录 key 的哈希：key 包含租户标识
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+
+class IdempotencyStore:
+    """
+    进程内的幂等记录：key -> 请求指纹与生成任务
+
+    - 首个请求创建生成任务，任务由记录持有；请求本身只等待它，客户端断开只结束等待，生成继续
+    - 相同 key、相同内容的重试直接拿到保存的结果，任务仍在进行时等待它完成
+    - 成功结果与 final_errors 中的确定性失败（如 400）作为最终结果保留 ttl_seconds，重试得到相同结果；
+      final_errors 中属于 transient_errors 的失败仍按临时失败处理
+    - 其他失败（超时、内部错误、任务被取消）不保存，等待中的重试会接手重新执行
+    - 相同 key、不同内容时抛出 IdempotencyConflict
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float,
+        final_errors: tuple[type[BaseException], ...] = (),
+        transient_errors: tuple[type[BaseException], ...] = (),
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.final_errors = final_errors
+        self.transient_errors = transient_errors
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    def _purge(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at is None or entry.expires_at > now:
+                break
+            del self._entries[key]
+
+    def _is_final(self, task: asyncio.Task) -> bool:
+        if not task.done() or task.cancelled():
+            return False
+        error = task.exception()
+        return error is None or (
+            isinstance(error, self.final_errors) and not isinstance(error, self.transient_errors)
+        )
+
+    def _settle(self, key: str, entry: _Entry, task: asyncio.Task) -> None:
+        """任务结束时调用：最终结果保留到过期，其他失败删除记录"""
+        if entry.expires_at is not None:
+            return
+        if self._is_final(task):
+            error = task.exception()
+            if error is None:
+                entry.result = task.result()
+            else:
+                entry.error = _detach(error)
+            entry.task = None
+            entry.expires_at = time.monotonic() + self.ttl_seconds
+            if self._entries.get(key) is entry:
+                self._entries.move_to_end(key)
+        elif self._entries.get(key) is entry:
+            del self._entries[key]
+
+    async def run(self, key: str, fingerprint: str, work: Callable[[], Awaitable[dict]]) -> dict:
+        while True:
+            self._purge()
+            entry = self._entries.get(key)
+            owner = entry is None
+
+            if owner:
+                entry = _Entry(fingerprint, asyncio.ensure_future(work()))
+                self._entries[key] = entry
+                entry.task.add_done_callback(lambda task, key=key, entry=entry: self._settle(key, entry, task))
+            elif entry.fingerprint != fingerprint:
+                logger.warning(f"Idempotency-Key 冲突: {_key_label(key)}")
+                raise IdempotencyConflict("Idempotency-Key 已用于内容不同的请求")
+            elif entry.task is None or entry.task.done():
+                logger.info(f"Idempotency-Key 命中已保存结果: {_key_label(key)}")
+            else:
+                logger.info(f"Idempotency-Key 对应请求仍在进行，等待其完成: {_key_label(key)}")
+
+            task = entry.task
+            if task is None:
+                if entry.error is not None:
+                    raise _detach(entry.error)
+                return dict(entry.result)
+
+            try:
+                # shield：调用方被取消（客户端断开）时只停止等待，不影响生成任务
+                return dict(await asyncio.shield(task))
+            except asyncio.CancelledError:
+                if not task.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                if owner:
+                    raise
+            except Exception:
+                if owner or self._is_final(task):
+                    raise
+            # 原请求未得到最终结果，重新进入循环由当前请求接手
+            self._settle(key, entry, task)
+            logger.info(f"Idempotency-Key 对应请求未成功，重新执行: {_key_label(key)}")
+
+
+@lru_cache(maxsize=1)
+def get_idempotency_store() -> IdempotencyStore:
+    # ServiceError 对应 400，重试同样会失败，按最终结果保存；上游 5xx、网络错误等 TransientServiceError 除外
+    return IdempotencyStore(
+        ttl_seconds=get_settings().IDEMPOTENCY_TTL_SECONDS,
+        final_errors=(ServiceError,),
+        transient_errors=(TransientServiceError,),
+    )
+
+
+def content_digest(content) -> bytes:
+    """单张图片内容的 sha256（在 CPU 执行器中运行，content 可以是 memoryview）"""
+    return hashlib.sha256(content).digest()
+
+
+def fingerprint_request(feature: str, items: list[tuple[str, str, bytes]]) -> str:
+    """按功能与每张上传图片（字段名、文件名、内容摘要）计算请求指纹"""
+    h = hashlib.sha256(feature.encode("utf-8"))
+    for field, filename, digest in items:
+        h.update(b"\0" + field.encode("utf-8") + b"\0" + (filename or "").encode("utf-8") + b"\0")
+        h.update(digest)
+    return h.hexdigest()
@@ -0,0 +1,208 @@
+import hashlib
+import io
+import json
+import threading
+from functools import lru_cache
+from pathlib import Path
+
+from PIL import Image
+
+from app.config import get_settings
+from app.utils.logger import get_logger
+
+logger = get_logger("phash_index")
+
+HASH_BITS = 64
+# 每张图片的色块布局：缩小到 4x4 后的 RGB 均值，共 48 字节
+COLOR_GRID = 4
+COLOR_BYTES = COLOR_GRID * COLOR_GRID * 3
+
+
+def image_signature(content) -> tuple[int, bytes] | None:
+    """
+    单张图片的感知签名 (dHash, 色块布局)；无法解码时返回 None
+
+    64 位差值哈希（dHash）对重新保存、重新压缩、轻微缩放不敏感，但只看灰度梯度，
+    同一图案换了配色哈希几乎不变，因此另外记录 4x4 色块的 RGB 均值用于区分配色
+    """
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            img.draft("RGB", (64, 64))  # JPEG 直接按缩小尺寸解码，减少开销
+            rgb = img.convert("RGB")
+            pixels = rgb.convert("L").resize((9, 8), Image.Resampling.LANCZOS).tobytes()
+            colors = rgb.resize((COLOR_GRID, COLOR_GRID), Image.Resampling.BOX).tobytes()
+    except Exception as e:
+        logger.warning(f"计算感知哈希失败: {e}")
+        return None
+
+    value = 0
+    for row in range(8):
+        base = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[base + col] > pixels[base + col + 1])
+    return value, colors
+
+
+def combine_signatures(signatures: list[tuple[int, bytes] | None]) -> tuple[int, bytes] | None:
+    """把一组图片的签名按顺序拼接：哈希拼成一个整数，色块依次连接；任一张无法解码则返回 None"""
+    combined = 0
+    colors = b""
+    for sig in signatures:
+        if sig is None:
+            return None
+        combined = (combined << HASH_BITS) | sig[0]
+        colors += sig[1]
+    return combined, colors
+
+
+def _max_image_distance(a: int, b: int, bits: int) -> int:
+    diff = a ^ b
+    mask = (1 << HASH_BITS) - 1
+    return max(((diff >> shift) & mask).bit_count() for shift in range(0, bits, HASH_BITS))
+
+
+def _tenant_hash(tenant) -> str:
+    # 索引文件只保存租户的哈希，不保存租户标识本身
+    return hashlib.sha256(str(tenant).encode("utf-8")).hexdigest()[:16]
+
+
+def _color_difference(a: bytes, b: bytes) -> int:
+    # 任一色块任一通道的最大差值（0~255）
+    if len(a) != len(b):
+        return 255
+    return max((abs(x - y) for x, y in zip(a, b)), default=0)
+
+
+class PerceptualIndex:
+    """
+    图片组感知哈希索引，按汉明距离查找近似重复
+
+    记录按 scope（租户、功能、分辨率）隔离，不同租户或分辨率之间不会互相命中；
+    内部和索引文件中租户均以哈希代替。
+    命中需同时满足：整组距离不超过 max_distance、每张图片的距离不超过 max_image_distance、
+    每个色块的颜色差不超过 max_color_diff。
+
+    使用多索引哈希：把哈希切成 max_distance + 1 段，距离不超过 max_distance 的两个哈希
+    至少有一段完全相同（鸽巢原理），因此只需校验段值命中的少量候选，
+    几十万条记录下查询仍在亚毫秒级
+    """
+
+    def __init__(
+        self,
+        max_distance: int,
+        path: Path | None = None,
+        max_image_distance: int | None = None,
+        max_color_diff: int = 255,
+    ):
+        self.max_distance = max(0, max_distance)
+        self.max_image_distance = self.max_distance if max_image_distance is None else max(0, max_image_distance)
+        self.max_color_diff = max(0, max_color_diff)
+        self.path = path
+        self._entries: list[tuple[int, int, bytes, str]] = []
+        self._buckets: dict[tuple, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def _segments(self, value: int, bits: int) -> list[tuple[int, int]]:
+        count = min(self.max_distance + 1, bits)
+        width = -(-bits // count)
+        mask = (1 << width) - 1
+        return [(i, (value >> (i * width)) & mask) for i in range(count)]
+
+    @staticmethod
+    def _scope_key(scope: tuple) -> tuple:
+        tenant, feature, resolution = scope
+        return _tenant_hash(tenant), feature, resolution
+
+    def _insert(self, scope: tuple, value: int, bits: int, colors: bytes, output: str) -> None:
+        idx = len(self._entries)
+        self._entries.append((value, bits, colors, output))
+        for seg in self._segments(value, bits):
+            self._buckets.setdefault((scope, bits, seg), []).append(idx)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, scope: tuple, value: int, bits: int, colors: bytes) -> tuple[str, int] | None:
+        """在 scope 内查找最近的近似重复，返回 (output, distance)"""
+        scope = self._scope_key(scope)
+        best = None
+        seen = set()
+        for seg in self._segments(value, bits):
+            for idx in self._buckets.get((scope, bits, seg), ()):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                other, _, other_colors, output = self._entries[idx]
+                distance = (value ^ other).bit_count()
+                if distance > self.max_distance or (best is not None and distance >= best[1]):
+                    continue
+                if _max_image_distance(value, other, bits) > self.max_image_distance:
+                    continue
+                if _color_difference(colors, other_colors) > self.max_color_diff:
+                    continue
+                best = (output, distance)
+                if distance == 0:
+                    return best
+        return best
+
+    def add(self, scope: tuple, value: int, bits: int, colors: bytes, output: str) -> None:
+        scope = self._scope_key(scope)
+        with self._lock:
+            self._insert(scope, value, bits, colors, output)
+            if self.path is None:
+                return
+            tenant_hash, feature, resolution = scope
+            try:
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps(
+                        {
+                            "tenant_hash": tenant_hash,
+                            "feature": feature,
+                            "resolution": resolution,
+                            "hash": format(value, "x"),
+                            "bits": bits,
+                            "colors": colors.hex(),
+                            "output": output,
+                        },
+                        ensure_ascii=False,
+                    ) + "\n")
+            except OSError as e:
+                logger.warning(f"写入感知哈希索引失败: {e}")
+
+    def load(self) -> int:
+        """加载索引文件；缺少租户哈希/分辨率/色块信息的旧记录无法安全复用，直接跳过"""
+        if self.path is None or not self.path.exists():
+            return 0
+        loaded = 0
+        with self.path.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                    scope = (item["tenant_hash"], item["feature"], item["resolution"])
+                    self._insert(
+                        scope, int(item["hash"], 16), int(item["bits"]), bytes.fromhex(item["colors"]), item["output"]
+                    )
+                    loaded += 1
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return loaded
+
+
+@lru_cache(maxsize=1)
+def get_phash_index() -> PerceptualIndex:
+    settings = get_settings()
+    # 默认放在 DATA_DIR：MEDIA_ROOT 通过 /media 公开，索引中的输出地址和签名不能被外部读取
+    path = Path(settings.PHASH_INDEX_PATH or Path(settings.DATA_DIR) / "phash_index.jsonl")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    index = PerceptualIndex(
+        max_distance=settings.PHASH_MAX_DISTANCE,
+        path=path,
+        max_image_distance=settings.PHASH_MAX_IMAGE_DISTANCE,
+        max_color_diff=settings.PHASH_MAX_COLOR_DIFF,
+    )
+    loaded = index.load()
+    logger.info(
+        f"感知哈希索引已加载: {loaded} 条, 最大距离 {index.max_distance}, "
+        f"单张最大距离 {index.max_image_distance}, 最大颜色差 {index.max_color_diff}"
+    )
+    return index
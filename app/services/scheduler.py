@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import itertools
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+
+from app.config import get_settings
+from app.utils.logger import get_logger
+
+logger = get_logger("scheduler")
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+
+class FairScheduler:
+    """
+    生成任务调度器：按租户加权公平排队（WFQ），交互优先于批量
+
+    - 全局并发上限 capacity，批量任务最多占用 batch_capacity，剩余槽位始终留给交互请求
+    - 每个租户同时最多运行 tenant_cap 个任务
+    - 同一优先级内按租户虚拟时间选择，权重越大，虚拟时间增长越慢，分到的份额越多
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        batch_capacity: int,
+        tenant_cap: int,
+        weights: dict[str, float] | None = None,
+    ):
+        self.capacity = max(1, capacity)
+        self.batch_capacity = max(0, min(batch_capacity, self.capacity))
+        self.tenant_cap = max(1, tenant_cap)
+        self.weights = dict(weights or {})
+
+        # priority -> tenant -> 等待中的 future 队列
+        self._queues: dict[str, dict[str, deque]] = {p: {} for p in PRIORITIES}
+        self._vtime: dict[str, float] = {}
+        self._vclock = 0.0
+        self._seq = itertools.count()
+        self._running = 0
+        self._running_by_priority = {p: 0 for p in PRIORITIES}
+        self._running_by_tenant: dict[str, int] = {}
+
+    def _weight(self, tenant: str) -> float:
+        w = self.weights.get(tenant, 1.0)
+        return w if w > 0 else 1.0
+
+    def _pick(self, priority: str) -> str | None:
+        best = None
+        best_key = None
+        for tenant, queue in self._queues[priority].items():
+            if not queue or self._running_by_tenant.get(tenant, 0) >= self.tenant_cap:
+                continue
+            key = (max(self._vtime.get(tenant, 0.0), self._vclock), queue[0][0])
+            if best_key is None or key < best_key:
+                best, best_key = tenant, key
+        return best
+
+    def _dispatch(self) -> None:
+        while self._running < self.capacity:
+            for priority in PRIORITIES:
+                if priority == BATCH and self._running_by_priority[BATCH] >= self.batch_capacity:
+                    continue
+                tenant = self._pick(priority)
+                if tenant is not None:
+                    break
+            else:
+                return
+
+            _, fut = self._queues[priority][tenant].popleft()
+            if not self._queues[priority][tenant]:
+                del self._queues[priority][tenant]
+            if fut.done():
+                # 排队中已被取消，slot() 中的清理还没来得及执行，跳过且不占用槽位
+                continue
+
+            self._acquire(tenant, priority)
+            fut.set_result(None)
+
+    def _acquire(self, tenant: str, priority: str) -> None:
+        start = max(self._vtime.get(tenant, 0.0), self._vclock)
+        self._vclock = start
+        self._vtime[tenant] = start + 1.0 / self._weight(tenant)
+
+        self._running += 1
+        self._running_by_priority[priority] += 1
+        self._running_by_tenant[tenant] = self._running_by_tenant.get(tenant, 0) + 1
+
+    def _release(self, tenant: str, priority: str) -> None:
+        self._running -= 1
+        self._running_by_priority[priority] -= 1
+        left = self._running_by_tenant.get(tenant, 1) - 1
+        if left > 0:
+            self._running_by_tenant[tenant] = left
+        else:
+            self._running_by_tenant.pop(tenant, None)
+        self._dispatch()
+
+    def _discard(self, tenant: str, priority: str, fut: asyncio.Future) -> None:
+        queue = self._queues[priority].get(tenant)
+        if not queue:
+            return
+        for item in queue:
+            if item[1] is fut:
+                queue.remove(item)
+                break
+        if not queue:
+            del self._queues[priority][tenant]
+
+    @asynccontextmanager
+    async def slot(self, tenant: str, priority: str = INTERACTIVE):
+        """排队直到获得执行槽位，退出时释放"""
+        if priority not in PRIORITIES:
+            priority = INTERACTIVE
+        fut = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(tenant, deque()).append((next(self._seq), fut))
+        self._dispatch()
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # 槽位已分配但调用方已取消，直接归还
+                self._release(tenant, priority)
+            else:
+                self._discard(tenant, priority, fut)
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(tenant, priority)
+
+    @contextmanager
+    def try_slot(self, tenant: str, priority: str = BATCH):
+        """
+        不排队的槽位：有空闲容量、未超过租户上限且没有请求在排队时立即占用并 yield True，否则 yield False
+
+        用于可以放弃的附加工作（如预览），不与排队中的请求争抢槽位
+        """
+        if priority not in PRIORITIES:
+            priority = INTERACTIVE
+        available = (
+            self._running < self.capacity
+            and (priority != BATCH or self._running_by_priority[BATCH] < self.batch_capacity)
+            and self._running_by_tenant.get(tenant, 0) < self.tenant_cap
+            and not any(self._queues[p] for p in PRIORITIES)
+        )
+        if not available:
+            yield False
+            return
+        self._acquire(tenant, priority)
+        try:
+            yield True
+        finally:
+            self._release(tenant, priority)
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "running_by_priority": dict(self._running_by_priority),
+            "running_by_tenant": dict(self._running_by_tenant),
+            "queued": {
+                p: {t: len(q) for t, q in tenants.items()}
+                for p, tenants in self._queues.items()
+            },
+        }
+
+
+@lru_cache(maxsize=1)
+def get_scheduler() -> FairScheduler:
+    settings = get_settings()
+    logger.info(
+        f"调度器初始化: 并发上限 {settings.SCHED_MAX_CONCURRENCY}, "
+        f"批量上限 {settings.SCHED_BATCH_MAX_CONCURRENCY}, "
+        f"单租户上限 {settings.SCHED_TENANT_MAX_CONCURRENCY}"
+    )
+    return FairScheduler(
+        capacity=settings.SCHED_MAX_CONCURRENCY,
+        batch_capacity=settings.SCHED_BATCH_MAX_CONCURRENCY,
+        tenant_cap=settings.SCHED_TENANT_MAX_CONCURRENCY,
+        weights=settings.SCHED_TENANT_WEIGHTS,
+    )
+
+
+def api_key_tenant(api_key: str) -> str:
+    """由 API Key 派生的租户 ID：sha256 前 16 位十六进制，密钥本身不会出现在统计、配置和日志中"""
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def resolve_tenant(request) -> tuple[str, str]:
+    """
+    从请求头解析 (租户, 优先级)
+
+    租户取 X-Tenant-ID；没有时由 X-API-Key 派生（见 api_key_tenant）；都没有则为 anonymous。
+    X-Priority 取 interactive/batch
+    """
+    headers = getattr(request, "headers", None) or {}
+    tenant = (headers.get("x-tenant-id") or "").strip()
+    if not tenant:
+        api_key = (headers.get("x-api-key") or "").strip()
+        tenant = api_key_tenant(api_key) if api_key else "anonymous"
+    priority = (headers.get("x-priority") or INTERACTIVE).strip().lower()
+    if priority not in PRIORITIES:
+        priority = INTERACTIVE
+    return tenant, priority
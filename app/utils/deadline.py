@@ -0,0 +1,102 @@
+import asyncio
+import math
+import threading
+import time
+
+from app.config import get_settings
+from app.utils.logger import get_logger
+
+logger = get_logger("deadline")
+
+
+class DeadlineExceeded(Exception):
+    """请求超过截止时间"""
+
+
+class ClientDisconnected(Exception):
+    """客户端已断开连接"""
+
+
+class DeadlineCancelled(Exception):
+    """截止时间已被取消（客户端断开、超时后的清理或调用方放弃），流水线应停止"""
+
+
+class Deadline:
+    """
+    请求截止时间与取消信号
+
+    event 是线程安全的，可传给在线程中执行的轮询逻辑，使其在取消后尽快退出
+    """
+
+    def __init__(self, timeout_seconds: float):
+        self.timeout_seconds = timeout_seconds
+        self.expires_at = time.monotonic() + timeout_seconds
+        self.event = threading.Event()
+
+    @classmethod
+    def from_request(cls, request=None) -> "Deadline":
+        """从 X-Request-Timeout 请求头（秒）读取超时，缺省或非法时使用配置默认值"""
+        settings = get_settings()
+        timeout = settings.REQUEST_TIMEOUT_SECONDS
+        headers = getattr(request, "headers", None) or {}
+        raw = (headers.get("x-request-timeout") or "").strip()
+        if raw:
+            try:
+                value = float(raw)
+            except ValueError:
+                value = math.nan
+            # nan、inf、0 和负数都视为非法，使用默认值；超过上限时截断到上限
+            if math.isfinite(value) and value > 0:
+                timeout = value
+            else:
+                logger.warning(f"忽略非法的 X-Request-Timeout: {raw!r}")
+        timeout = max(0.0, min(timeout, settings.REQUEST_TIMEOUT_MAX_SECONDS))
+        return cls(timeout)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def cancel(self) -> None:
+        self.event.set()
+
+    def check(self) -> None:
+        """已取消或已超时时抛出异常，供流水线各阶段之间调用"""
+        if self.cancelled:
+            raise DeadlineCancelled("deadline cancelled")
+        if self.expired:
+            self.cancel()
+            raise DeadlineExceeded(f"request exceeded {self.timeout_seconds:.1f}s deadline")
+
+
+async def run_with_deadline(coro, deadline: Deadline, request=None, poll_interval: float | None = None):
+    """
+    执行协程，超时或客户端断开时取消它
+
+    超时抛出 DeadlineExceeded，断开抛出 ClientDisconnected；两种情况下都会设置 deadline 的取消信号
+    """
+    interval = poll_interval if poll_interval is not None else get_settings().DISCONNECT_POLL_INTERVAL
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=min(interval, deadline.remaining()))
+            if task in done:
+                return task.result()
+            if deadline.expired:
+                logger.warning(f"请求超时（{deadline.timeout_seconds:.1f}秒），取消处理")
+                raise DeadlineExceeded(f"request exceeded {deadline.timeout_seconds:.1f}s deadline")
+            if request is not None and await request.is_disconnected():
+                logger.warning("客户端已断开，取消处理")
+                raise ClientDisconnected("client disconnected")
+    finally:
+        if not task.done():
+            deadline.cancel()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
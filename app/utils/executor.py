@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing import shared_memory
+from typing import Any, Callable
+
+from app.config import get_settings
+from app.utils.logger import get_logger
+
+logger = get_logger("executor")
+
+
+class _LatencyWindow:
+    """最近若干个耗时样本（秒），报告毫秒级统计"""
+
+    def __init__(self, size: int = 1000):
+        self._samples: deque = deque(maxlen=size)
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def report(self) -> dict:
+        ordered = sorted(self._samples)
+        if not ordered:
+            return {"count": self.count, "avg_ms": None, "p99_ms": None, "max_ms": None}
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        return {
+            "count": self.count,
+            "avg_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+            "p99_ms": round(p99 * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+queue_wait = _LatencyWindow()
+loop_lag = _LatencyWindow()
+
+
+@lru_cache(maxsize=1)
+def get_cpu_executor() -> Executor:
+    """CPU 密集型任务的执行器，CPU_EXECUTOR 取 thread 或 process"""
+    settings = get_settings()
+    workers = settings.CPU_WORKERS or os.cpu_count() or 1
+    if settings.CPU_EXECUTOR == "process":
+        logger.info(f"CPU 执行器: 进程池, {workers} 个进程")
+        return ProcessPoolExecutor(max_workers=workers)
+    logger.info(f"CPU 执行器: 线程池, {workers} 个线程")
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cpu")
+
+
+@lru_cache(maxsize=1)
+def _thread_executor() -> ThreadPoolExecutor:
+    # 进程池模式下，无法传给子进程的任务（如读取已打开的 ZIP）使用的线程池
+    workers = get_settings().CPU_WORKERS or os.cpu_count() or 1
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cpu-local")
+
+
+def shutdown_cpu_executor() -> None:
+    for factory in (get_cpu_executor, _thread_executor):
+        if factory.cache_info().currsize:
+            factory().shutdown(wait=False, cancel_futures=True)
+            factory.cache_clear()
+
+
+def _timed(submitted_at: float, fn: Callable, *args) -> tuple[float, Any]:
+    # time.time() 在进程间可比较，用于计算排队等待时间
+    started_at = time.time()
+    return started_at - submitted_at, fn(*args)
+
+
+def _timed_on_shm(submitted_at: float, name: str, size: int, fn: Callable, *args) -> tuple[float, Any]:
+    started_at = time.time()
+    # 子进程只是借用，由父进程负责 unlink
+    shm = shared_memory.SharedMemory(name=name)
+    view = shm.buf[:size]
+    try:
+        return started_at - submitted_at, fn(view, *args)
+    finally:
+        view.release()
+        shm.close()
+
+
+async def run_cpu(fn: Callable, *args) -> Any:
+    """在 CPU 执行器中运行 fn(*args)，记录排队等待时间"""
+    loop = asyncio.get_running_loop()
+    waited, result = await loop.run_in_executor(get_cpu_executor(), _timed, time.time(), fn, *args)
+    queue_wait.record(waited)
+    return result
+
+
+async def run_cpu_in_thread(fn: Callable, *args) -> Any:
+    """
+    在线程中运行 fn(*args)，用于参数无法序列化到子进程的 CPU 任务（如解压已打开的 ZIP 成员）
+
+    thread 模式下与 run_cpu 相同；process 模式下使用同样大小的独立线程池
+    """
+    executor = get_cpu_executor()
+    if isinstance(executor, ProcessPoolExecutor):
+        executor = _thread_executor()
+    loop = asyncio.get_running_loop()
+    waited, result = await loop.run_in_executor(executor, _timed, time.time(), fn, *args)
+    queue_wait.record(waited)
+    return result
+
+
+async def run_cpu_on_buffer(fn: Callable, data: bytes, *args) -> Any:
+    """
+    在 CPU 执行器中运行 fn(buffer, *args)，buffer 为只读的字节视图
+
+    线程池直接传递 memoryview，不复制；进程池通过共享内存传递，只复制一次，避免 pickle 大块数据
+    """
+    executor = get_cpu_executor()
+    if not isinstance(executor, ProcessPoolExecutor) or not data:
+        return await run_cpu(fn, memoryview(data), *args)
+
+    loop = asyncio.get_running_loop()
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    try:
+        shm.buf[:len(data)] = data
+        waited, result = await loop.run_in_executor(
+            executor, _timed_on_shm, time.time(), shm.name, len(data), fn, *args
+        )
+    finally:
+        shm.close()
+        shm.unlink()
+    queue_wait.record(waited)
+    return result
+
+
+async def monitor_loop_lag(interval: float = 0.1) -> None:
+    """定期测量事件循环调度延迟（实际唤醒时间减去预期时间）"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        loop_lag.record(max(0.0, loop.time() - expected))
+
+
+def executor_report() -> dict:
+    settings = get_settings()
+    return {
+        "mode": settings.CPU_EXECUTOR,
+        "workers": settings.CPU_WORKERS or os.cpu_count() or 1,
+        "queue_wait": queue_wait.report(),
+        "loop_lag": loop_lag.report(),
+    }
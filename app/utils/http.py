@@ -1,6 +1,14 @@
+import threading
 import time
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlsplit
+
 import requests
-from app.config import settings
+from requests.adapters import HTTPAdapter
+
+from app.config import get_settings
 from app.utils.logger import get_logger
 
 logger = get_logger("http")
@@ -15,8 +23,16 @@ class APIRequestError(RuntimeError):
         self.response_text = response_text
 
 
-session = requests.Session()
-session.trust_env = False
+@lru_cache(maxsize=1)
+def get_session() -> requests.Session:
+    """共享的上游会话，连接池大小取自配置"""
+    pool_size = get_settings().HTTP_POOL_MAXSIZE
+    s = requests.Session()
+    s.trust_env = False
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
 
 
 def _clean_str(v: str | None) -> str:
@@ -36,13 +52,47 @@ def _clean_key(key: str | None) -> str:
 
 
 def _headers(api_key: str | None) -> dict:
-    k = _clean_key(api_key or settings.API_KEY)
+    k = _clean_key(api_key or get_settings().API_KEY)
     return {
         "Authorization": f"Bearer {k}",
         "Content-Type": "application/json",
     }
 
 
+def prewarm_upstream(
+    api_url: str | None = None,
+    connections: int | None = None,
+    timeout: float | None = None,
+) -> int:
+    """提前完成 DNS 解析与 TLS 握手，把连接留在连接池里，返回成功建立的连接数"""
+    cfg = get_settings()
+    url = _clean_url(api_url or cfg.API_URL)
+    n = cfg.HTTP_PREWARM_CONNECTIONS if connections is None else connections
+    t = cfg.HTTP_PREWARM_TIMEOUT if timeout is None else timeout
+    if n <= 0 or not (url.startswith("http://") or url.startswith("https://")):
+        logger.info("跳过上游连接预热")
+        return 0
+
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}/"
+    session = get_session()
+
+    def _open() -> bool:
+        try:
+            # 任意状态码都说明连接已建立；关闭响应后连接归还连接池
+            with session.head(origin, timeout=t, allow_redirects=False):
+                return True
+        except requests.RequestException as e:
+            logger.warning(f"上游连接预热失败: {e}")
+            return False
+
+    # 并发发起，才能在池中留下多条连接
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        ok = sum(pool.map(lambda _: _open(), range(n)))
+    logger.info(f"上游连接预热完成: {ok}/{n} -> {origin}")
+    return ok
+
+
 def post_edit(
     payload: dict,
     api_url: str | None = None,
@@ -50,7 +100,7 @@ def post_edit(
     timeout: int = 180,
 ) -> dict:
     """调用 API 进行图像编辑"""
-    url = _clean_url(api_url or settings.API_URL)
+    url = _clean_url(api_url or get_settings().API_URL)
     if not url:
         logger.error("API_URL is empty. Check your .env / settings loading.")
         raise APIRequestError("API_URL is empty. Check your .env / settings loading.")
@@ -64,7 +114,7 @@ def post_edit(
     logger.debug(f"请求体大小: {len(str(payload))} bytes")
 
     try:
-        resp = session.post(url, headers=headers, json=payload, timeout=timeout)
+        resp = get_session().post(url, headers=headers, json=payload, timeout=timeout)
         logger.info(f"API 响应状态码: {resp.status_code}")
     except requests.RequestException as e:
         logger.error(f"网络请求失败: {e}")
@@ -122,7 +172,7 @@ def get_json(
     logger.debug(f"请求头: {headers}")
 
     try:
-        resp = session.get(u, headers=headers, timeout=timeout)
+        resp = get_session().get(u, headers=headers, timeout=timeout)
         logger.info(f"GET 请求响应状态码: {resp.status_code}")
     except requests.RequestException as e:
         logger.error(f"GET 请求网络错误: {e}")
@@ -152,21 +202,76 @@ def get_json(
         )
 
 
+def cancel_task(
+    cancel_url: str,
+    api_key: str | None = None,
+    timeout: int = 10,
+) -> bool:
+    """尽力取消上游任务（仅当上游返回了取消地址时可用），失败只记录日志"""
+    u = _clean_url(cancel_url)
+    if not (u.startswith("http://") or u.startswith("https://")):
+        return False
+    try:
+        resp = get_session().post(u, headers=_headers(api_key), timeout=timeout)
+        logger.info(f"取消上游任务，响应状态码: {resp.status_code}")
+        return resp.status_code < 400
+    except requests.RequestException as e:
+        logger.warning(f"取消上游任务失败: {e}")
+        return False
+
+
 def wait_for_outputs(
     result_url: str,
     api_key: str | None = None,
-    timeout_seconds: int = 180,
+    timeout_seconds: float = 180,
     poll_interval: float = 1.0,
+    cancel_event: threading.Event | None = None,
+    schedule: Sequence[float] | None = None,
 ) -> dict:
-    """轮询 API 直到获取输出结果"""
+    """
+    轮询 API 直到获取输出结果；cancel_event 被设置时停止轮询
+
+    schedule 为相对开始时刻的轮询时间点（秒），提供时取代固定间隔，用完即视为超时
+    """
     start = time.time()
     last: dict | None = None
+    planned = iter(schedule) if schedule is not None else None
+    polls = 0
     logger.info(f"开始轮询 API 结果，URL: {result_url}")
-    logger.info(f"轮询超时时间: {timeout_seconds}秒，轮询间隔: {poll_interval}秒")
+    if planned is not None:
+        logger.info(f"轮询超时时间: {timeout_seconds}秒，计划轮询 {len(schedule)} 次")
+    else:
+        logger.info(f"轮询超时时间: {timeout_seconds}秒，轮询间隔: {poll_interval}秒")
+
+    def _sleep(seconds: float) -> None:
+        if seconds <= 0:
+            return
+        if cancel_event is not None:
+            cancel_event.wait(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _next_wait() -> float | None:
+        if planned is None:
+            return poll_interval
+        offset = next(planned, None)
+        if offset is None:
+            return None
+        return offset - (time.time() - start)
+
+    if planned is not None:
+        first = _next_wait()
+        if first is not None:
+            _sleep(first)
 
     while True:
+        if cancel_event is not None and cancel_event.is_set():
+            logger.warning("轮询已取消")
+            raise APIRequestError("Polling cancelled")
+
         elapsed = time.time() - start
-        logger.debug(f"轮询第 {elapsed/poll_interval:.0f} 次，已耗时: {elapsed:.1f}秒")
+        polls += 1
+        logger.debug(f"轮询第 {polls} 次，已耗时: {elapsed:.1f}秒")
         
         last = get_json(result_url, api_key=api_key, timeout=60)
 
@@ -179,7 +284,7 @@ def wait_for_outputs(
         logger.info(f"轮询状态: {status}, 输出数量: {len(outputs)}")
 
         if outputs:
-            logger.info("轮询成功获取输出结果")
+            logger.info(f"轮询成功获取输出结果，共轮询 {polls} 次")
             return last
 
         if status in {"completed", "succeeded"}:
@@ -191,9 +296,10 @@ def wait_for_outputs(
             logger.error(f"上游任务执行失败 ({status}): {error_msg}")
             raise APIRequestError(f"Upstream task {status}: {error_msg}")
 
-        if time.time() - start > timeout_seconds:
+        wait = _next_wait()
+        if wait is None or time.time() - start > timeout_seconds:
             logger.error(f"轮询超时，最后状态: {status}, 数据: {data}")
             raise APIRequestError(f"Timeout waiting for outputs. Last status={status}, data={data}")
 
-        logger.debug(f"继续轮询，等待 {poll_interval} 秒")
-        time.sleep(poll_interval)
\ No newline at end of file
+        logger.debug(f"继续轮询，等待 {max(wait, 0):.2f} 秒")
+        _sleep(wait)
@@ -1,32 +1,39 @@
 import logging
 import os
+from functools import lru_cache
 from pathlib import Path
 
 
+@lru_cache(maxsize=1)
+def _shared_handlers() -> tuple[logging.Handler, ...]:
+    """日志目录和处理器只创建一次，所有 logger 共用"""
+    # 创建日志目录
+    log_dir = Path(os.getenv("LOG_DIR", "./logs"))
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    # 创建格式化器
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # 创建控制台处理器
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(formatter)
+
+    # 创建文件处理器
+    file_handler = logging.FileHandler(log_dir / f"app.log", encoding="utf-8")
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(formatter)
+
+    return console_handler, file_handler
+
+
 def get_logger(name: str) -> logging.Logger:
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
-    
+
     if not logger.handlers:
-        # 创建日志目录
-        log_dir = Path(os.getenv("LOG_DIR", "./logs"))
-        log_dir.mkdir(parents=True, exist_ok=True)
-        
-        # 创建格式化器
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        
-        # 创建控制台处理器
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        console_handler.setFormatter(formatter)
-        
-        # 创建文件处理器
-        file_handler = logging.FileHandler(log_dir / f"app.log", encoding="utf-8")
-        file_handler.setLevel(logging.INFO)
-        file_handler.setFormatter(formatter)
-        
         # 添加处理器
-        logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
-    
-    return logger
\ No newline at end of file
+        for handler in _shared_handlers():
+            logger.addHandler(handler)
+
+    return logger
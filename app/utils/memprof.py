@@ -0,0 +1,217 @@
+import asyncio
+import random
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+from app.config import get_settings
+from app.utils.logger import get_logger
+
+logger = get_logger("memprof")
+
+# 只记录分配点所在的一帧，快照与对比的开销最小
+TRACEBACK_LIMIT = 1
+
+# 快照中排除 tracemalloc 自身与导入系统的分配
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+
+
+class _NullProfile:
+    """未被采样的请求使用，所有操作都是空操作"""
+
+    def stage(self, name: str):
+        return nullcontext()
+
+    async def begin(self) -> None:
+        pass
+
+    async def capture(self, label: str) -> None:
+        pass
+
+    def finish(self, error: bool = False) -> None:
+        pass
+
+
+NULL_PROFILE = _NullProfile()
+
+
+class RequestProfile:
+    """
+    单个请求的内存画像：每个阶段的峰值增量，以及指定时刻相对请求开始的主要分配位置
+
+    阶段统计只调用 get_traced_memory/reset_peak，开销很小；快照与对比较慢，
+    只在 begin() 与 capture() 中进行，并放到线程里执行
+    """
+
+    def __init__(self, profiler: "MemoryProfiler", feature: str):
+        self.profiler = profiler
+        self.feature = feature
+        self.started_at = time.time()
+        self.stages: list[dict] = []
+        self.allocations: dict[str, list[dict]] = {}
+        self._baseline = tracemalloc.get_traced_memory()[0]
+        self._before: tracemalloc.Snapshot | None = None
+
+    @contextmanager
+    def stage(self, name: str):
+        if not tracemalloc.is_tracing():
+            # 采样过程中被关闭
+            yield
+            return
+        start_current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            if tracemalloc.is_tracing():
+                self._record(name, start_current, t0)
+
+    def _record(self, name: str, start_current: int, t0: float) -> None:
+        current, peak = tracemalloc.get_traced_memory()
+        self.stages.append({
+            "stage": name,
+            "seconds": round(time.perf_counter() - t0, 4),
+            "peak_bytes": peak - start_current,
+            "retained_bytes": current - start_current,
+            "peak_over_request_bytes": peak - self._baseline,
+        })
+
+    async def begin(self) -> None:
+        """请求开始时的基准快照（top_n 为 0 时不取）"""
+        if self.profiler.top_n and tracemalloc.is_tracing():
+            self._before = await asyncio.to_thread(_take_snapshot)
+
+    async def capture(self, label: str) -> None:
+        """在大块缓冲仍存活时调用，记录相对基准快照增长最多的分配位置"""
+        before, top_n = self._before, self.profiler.top_n
+        if before is None or not top_n or not tracemalloc.is_tracing():
+            return
+
+        def _diff() -> list[dict]:
+            return [
+                {
+                    "site": str(diff.traceback[0]),
+                    "size_diff_bytes": diff.size_diff,
+                    "count_diff": diff.count_diff,
+                }
+                for diff in _take_snapshot().compare_to(before, "lineno")[:top_n]
+            ]
+
+        self.allocations[label] = await asyncio.to_thread(_diff)
+
+    def finish(self, error: bool = False) -> None:
+        self._before = None
+        self.profiler._finish(self, error)
+
+
+class MemoryProfiler:
+    """
+    运行时可开关的请求内存采样（tracemalloc）
+
+    tracemalloc 是进程级的，峰值无法区分并发请求，因此同一时刻只对一个请求采样，
+    其他请求在此期间直接跳过；采样期间的分配仍会计入所有线程的内存
+    """
+
+    def __init__(self, sample_rate: float = 0.1, top_n: int = 10, history_size: int = 50):
+        self.enabled = False
+        self.sample_rate = sample_rate
+        self.top_n = top_n
+        self._active = False
+        self._lock = threading.Lock()
+        self._recent: deque = deque(maxlen=history_size)
+        self._summary: dict[str, dict] = {}
+
+    def configure(self, enabled: bool | None = None, sample_rate: float | None = None, top_n: int | None = None) -> None:
+        with self._lock:
+            if sample_rate is not None:
+                self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+            if top_n is not None:
+                self.top_n = max(0, top_n)
+            if enabled is not None and enabled != self.enabled:
+                self.enabled = enabled
+                if enabled:
+                    if not tracemalloc.is_tracing():
+                        tracemalloc.start(TRACEBACK_LIMIT)
+                elif tracemalloc.is_tracing():
+                    tracemalloc.stop()
+                logger.info(f"内存采样已{'开启' if enabled else '关闭'}，采样率 {self.sample_rate}")
+
+    def start(self, feature: str) -> RequestProfile | _NullProfile:
+        if not self.enabled or random.random() >= self.sample_rate:
+            return _NullProfile()
+        with self._lock:
+            if self._active or not tracemalloc.is_tracing():
+                return _NullProfile()
+            self._active = True
+        return RequestProfile(self, feature)
+
+    def _finish(self, profile: RequestProfile, error: bool) -> None:
+        with self._lock:
+            self._active = False
+            self._recent.append({
+                "feature": profile.feature,
+                "started_at": profile.started_at,
+                "error": error,
+                "stages": profile.stages,
+                "top_allocations": profile.allocations,
+            })
+            summary = self._summary.setdefault(profile.feature, {"samples": 0, "stages": {}})
+            summary["samples"] += 1
+            for record in profile.stages:
+                agg = summary["stages"].setdefault(
+                    record["stage"], {"count": 0, "total_peak_bytes": 0, "max_peak_bytes": 0}
+                )
+                agg["count"] += 1
+                agg["total_peak_bytes"] += record["peak_bytes"]
+                agg["max_peak_bytes"] = max(agg["max_peak_bytes"], record["peak_bytes"])
+
+    def report(self, recent: int = 10) -> dict:
+        with self._lock:
+            features = {}
+            for feature, summary in self._summary.items():
+                features[feature] = {
+                    "samples": summary["samples"],
+                    "stages": {
+                        name: {
+                            "count": agg["count"],
+                            "avg_peak_bytes": agg["total_peak_bytes"] // max(agg["count"], 1),
+                            "max_peak_bytes": agg["max_peak_bytes"],
+                        }
+                        for name, agg in summary["stages"].items()
+                    },
+                }
+            return {
+                "enabled": self.enabled,
+                "sample_rate": self.sample_rate,
+                "top_n": self.top_n,
+                "traced_memory_bytes": tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+                "features": features,
+                "recent": list(self._recent)[-recent:] if recent > 0 else [],
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._recent.clear()
+            self._summary.clear()
+
+
+@lru_cache(maxsize=1)
+def get_memory_profiler() -> MemoryProfiler:
+    settings = get_settings()
+    profiler = MemoryProfiler(sample_rate=settings.MEMPROF_SAMPLE_RATE, top_n=settings.MEMPROF_TOP_N)
+    if settings.MEMPROF_ENABLED:
+        profiler.configure(enabled=True)
+    return profiler
@@ -0,0 +1,134 @@
+import math
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+
+from app.config import get_settings
+from app.utils.logger import get_logger
+
+logger = get_logger("polling")
+
+
+class CompletionStats:
+    """按功能记录最近的任务完成耗时（秒，从提交上游算起），用于估计完成时间分布"""
+
+    def __init__(self, history_size: int = 200):
+        self.history_size = max(1, history_size)
+        self._samples: dict[str, deque] = {}
+
+    def record(self, feature: str, seconds: float) -> None:
+        if seconds < 0:
+            return
+        samples = self._samples.get(feature)
+        if samples is None:
+            samples = self._samples[feature] = deque(maxlen=self.history_size)
+        samples.append(seconds)
+
+    def count(self, feature: str) -> int:
+        return len(self._samples.get(feature) or ())
+
+    def percentile(self, feature: str, q: float) -> float | None:
+        """q 取 0~1，线性插值；没有样本时返回 None"""
+        samples = self._samples.get(feature)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        pos = min(max(q, 0.0), 1.0) * (len(ordered) - 1)
+        lo = int(pos)
+        hi = min(lo + 1, len(ordered) - 1)
+        return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+    def summary(self) -> dict:
+        return {
+            feature: {
+                "count": len(samples),
+                "p50": self.percentile(feature, 0.5),
+                "p90": self.percentile(feature, 0.9),
+                "p99": self.percentile(feature, 0.99),
+            }
+            for feature, samples in self._samples.items()
+        }
+
+
+@lru_cache(maxsize=1)
+def get_completion_stats() -> CompletionStats:
+    return CompletionStats(history_size=get_settings().POLL_HISTORY_SIZE)
+
+
+def reported_duration(data: dict | None) -> float | None:
+    """
+    上游报告的任务耗时（秒）：优先 completed_at - created_at，其次 timings.inference（毫秒）
+
+    轮询只能在某次查询时发现任务已完成，报告耗时比观测值更接近真实完成时间；没有相关字段时返回 None
+    """
+    if not isinstance(data, dict):
+        return None
+    created, completed = data.get("created_at"), data.get("completed_at")
+    if isinstance(created, str) and isinstance(completed, str):
+        try:
+            seconds = (datetime.fromisoformat(completed) - datetime.fromisoformat(created)).total_seconds()
+            if seconds >= 0:
+                return seconds
+        except (ValueError, TypeError):
+            pass
+    timings = data.get("timings")
+    inference = timings.get("inference") if isinstance(timings, dict) else None
+    if isinstance(inference, (int, float)) and inference >= 0:
+        return inference / 1000.0
+    return None
+
+
+def plan_polls(
+    stats: CompletionStats,
+    feature: str,
+    timeout_seconds: float,
+    budget: int,
+    min_interval: float = 0.5,
+    fallback_interval: float = 1.0,
+    min_samples: int = 5,
+) -> list[float]:
+    """
+    生成轮询时间点（相对提交时刻的秒数）
+
+    样本不足时按 fallback_interval 固定间隔轮询到超时（与原实现一致，不受 budget 限制）。
+    样本足够时总数不超过 budget：
+    - 最早样本之前放几个几何递减的探测点（最早样本的 1/2、1/4……），上游变快时也能被发现
+    - 约 2/3 的预算按历史完成时间的分位数放置（逆 CDF 采样），完成最集中的区间轮询最密
+    - 剩余预算均匀铺到超时时刻，最后一次轮询总在超时时刻，保证慢任务也能被拿到结果
+    """
+    if stats.count(feature) < min_samples:
+        count = max(1, math.ceil(timeout_seconds / fallback_interval))
+        return [min(fallback_interval * (i + 1), timeout_seconds) for i in range(count)]
+
+    budget = max(1, budget)
+    # 最后一个名额始终留给超时时刻，其余预算的约 2/3 用于探测点与分位数点
+    n_core = min(budget * 2 // 3, budget - 1)
+
+    probes = []
+    t = stats.percentile(feature, 0.0) / 2
+    while len(probes) < min(max(1, budget // 8), n_core - 1) and t >= min_interval:
+        probes.append(t)
+        t /= 2
+    n_quantiles = n_core - len(probes)
+    core = probes + [stats.percentile(feature, (i + 1) / n_quantiles) for i in range(n_quantiles)]
+
+    offsets: list[float] = []
+    last = 0.0
+    for t in sorted(core):
+        t = min(max(t, last + min_interval), timeout_seconds)
+        if t >= timeout_seconds:
+            break
+        if offsets and t - offsets[-1] < min_interval:
+            continue
+        offsets.append(t)
+        last = t
+
+    remaining = budget - len(offsets)
+    step = max((timeout_seconds - last) / remaining, min_interval)
+    for k in range(1, remaining):
+        t = last + step * k
+        if t >= timeout_seconds:
+            break
+        offsets.append(t)
+    offsets.append(timeout_seconds)
+    return offsets
@@ -0,0 +1,5 @@
+"""图像生成 API 的异步 Python 客户端"""
+
+from mcpp_client.client import FEATURES, AsyncMCPPClient, Job, JobResult, MCPPError
+
+__all__ = ["FEATURES", "AsyncMCPPClient", "Job", "JobResult", "MCPPError"]
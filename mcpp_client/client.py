@@ -0,0 +1,281 @@
+import asyncio
+import os
+import random
+import uuid
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterable, Mapping, Sequence, Union
+
+import httpx
+
+# 与服务端 /generate/* 端点对应的功能名
+FEATURES = (
+    "product_main",
+    "product_display_1",
+    "product_size",
+    "product_display_2",
+    "scene_display_1",
+    "scene_display_2",
+)
+
+# 上传字段顺序：纸巾、6寸餐盘、9寸餐盘、刀叉
+SLOTS = ("image1", "image2", "image3", "image4")
+
+# 可重试的状态码：限流与网关/服务不可用。504 表示服务端已超时并取消了生成，500 重试通常只会重复崩溃
+RETRY_STATUS = {429, 502, 503}
+
+# 可重试的网络错误：都发生在请求发出之前，服务端不可能已开始生成
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+ImageSource = Union[str, os.PathLike, bytes, tuple]
+Images = Union[Mapping[str, ImageSource], Sequence[ImageSource]]
+
+
+class MCPPError(RuntimeError):
+    """API 调用失败"""
+
+    def __init__(self, message: str, status_code: int | None = None, detail: Any = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class Job:
+    """一次生成任务：功能、四张图片，以及调用方自定义的标识"""
+
+    def __init__(self, feature: str, images: Images, tag: Any = None, idempotency_key: str | None = None):
+        self.feature = feature
+        self.images = images
+        self.tag = tag
+        # 同一任务的所有重试共用一个 key；重新提交同一个 Job 时服务端返回已保存或进行中的结果
+        self.idempotency_key = idempotency_key or uuid.uuid4().hex
+
+    def __repr__(self) -> str:
+        return f"Job(feature={self.feature!r}, tag={self.tag!r})"
+
+
+class JobResult:
+    """批量提交的单个结果；成功时 result 为服务端响应，失败时 error 为异常"""
+
+    def __init__(self, job: Job, result: dict | None = None, error: Exception | None = None):
+        self.job = job
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def output(self) -> str | None:
+        return (self.result or {}).get("output")
+
+
+def _slot_items(images: Images) -> list[tuple[str, ImageSource]]:
+    if isinstance(images, Mapping):
+        missing = [s for s in SLOTS if s not in images]
+        if missing:
+            raise ValueError(f"missing images: {missing}")
+        return [(slot, images[slot]) for slot in SLOTS]
+    if len(images) != len(SLOTS):
+        raise ValueError(f"expected {len(SLOTS)} images, got {len(images)}")
+    return list(zip(SLOTS, images))
+
+
+class _OpenedFiles:
+    """按来源构造 multipart 字段；路径在每次尝试时重新打开，由 httpx 分块读取，不整体载入内存"""
+
+    def __init__(self, images: Images):
+        self._items = _slot_items(images)
+        self._handles: list = []
+
+    def __enter__(self) -> list:
+        files = []
+        for slot, source in self._items:
+            if isinstance(source, (str, os.PathLike)):
+                path = Path(source)
+                handle = path.open("rb")
+                self._handles.append(handle)
+                files.append((slot, (path.name, handle)))
+            elif isinstance(source, bytes):
+                files.append((slot, (f"{slot}.png", source)))
+            elif isinstance(source, tuple):
+                files.append((slot, source))
+            else:
+                raise TypeError(f"unsupported image source for {slot}: {type(source).__name__}")
+        return files
+
+    def __exit__(self, *exc) -> None:
+        for handle in self._handles:
+            handle.close()
+        self._handles.clear()
+
+
+class AsyncMCPPClient:
+    """
+    图像生成 API 的异步客户端
+
+    - 复用连接池（max_connections），同时在途的请求不超过 max_concurrency
+    - 只自动重试确定没有开始生成的失败：连接建立前的网络错误与 429/502/503，指数退避加随机抖动，并遵守 Retry-After
+    - 每个任务自动携带 Idempotency-Key；读超时等其他错误不自动重试，调用方重新提交同一个 Job
+      时，服务端会返回仍在进行或已保存的结果，而不是重新生成
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str | None = None,
+        tenant: str | None = None,
+        priority: str | None = None,
+        timeout: float = 200.0,
+        request_timeout: float | None = None,
+        max_connections: int = 20,
+        max_concurrency: int = 6,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 10.0,
+    ):
+        headers = {}
+        if api_key:
+            headers["X-API-Key"] = api_key
+        if tenant:
+            headers["X-Tenant-ID"] = tenant
+        if priority:
+            headers["X-Priority"] = priority
+        if request_timeout is not None:
+            headers["X-Request-Timeout"] = str(request_timeout)
+
+        self._http = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            headers=headers,
+            timeout=httpx.Timeout(timeout, connect=10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self._limit = asyncio.Semaphore(max(1, max_concurrency))
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    async def __aenter__(self) -> "AsyncMCPPClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    def _backoff(self, attempt: int, retry_after: str | None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        # full jitter
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def generate(
+        self,
+        feature: str,
+        images: Images,
+        idempotency_key: str | None = None,
+    ) -> dict:
+        """调用 /generate/{feature}，返回 {"status", "output", "mode"}"""
+        return await self._submit(Job(feature, images, idempotency_key=idempotency_key))
+
+    async def _submit(self, job: Job) -> dict:
+        async with self._limit:
+            return await self._post_with_retries(job)
+
+    async def _post_with_retries(self, job: Job) -> dict:
+        url = f"/generate/{job.feature}"
+        headers = {"Idempotency-Key": job.idempotency_key}
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                with _OpenedFiles(job.images) as files:
+                    resp = await self._http.post(url, files=files, headers=headers)
+            except RETRY_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise MCPPError(f"network error: {e}") from e
+            except httpx.HTTPError as e:
+                # 请求可能已送达：不自动重试，由调用方用同一个 Job 重新提交
+                raise MCPPError(f"network error: {e}") from e
+            else:
+                if resp.status_code < 400:
+                    return resp.json()
+                detail = _detail(resp)
+                if resp.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                    raise MCPPError(
+                        f"{url} returned {resp.status_code}: {detail}",
+                        status_code=resp.status_code,
+                        detail=detail,
+                    )
+                retry_after = resp.headers.get("retry-after")
+
+            await asyncio.sleep(self._backoff(attempt, retry_after))
+            attempt += 1
+
+    async def iter_generate(self, jobs: Iterable[Job]) -> AsyncIterator[JobResult]:
+        """
+        并发提交多个任务，按完成顺序逐个产出 JobResult
+
+        任务按需从 jobs 中取出，与 generate() 共用 max_concurrency 限制，适合很长的任务列表
+        """
+        async for _, item in self._iter_indexed(enumerate(jobs)):
+            yield item
+
+    async def _iter_indexed(self, jobs: Iterable[tuple[int, Job]]) -> AsyncIterator[tuple[int, JobResult]]:
+        """iter_generate 的实现：输入 (序号, Job)，产出 (序号, JobResult)，同一个 Job 对象出现多次时也能区分"""
+        pending: set[asyncio.Task] = set()
+        jobs = iter(jobs)
+
+        async def _one(index: int, job: Job) -> tuple[int, JobResult]:
+            try:
+                return index, JobResult(job, result=await self._submit(job))
+            except Exception as e:
+                return index, JobResult(job, error=e)
+
+        def _fill() -> None:
+            while len(pending) < self.max_concurrency:
+                item = next(jobs, None)
+                if item is None:
+                    return
+                pending.add(asyncio.create_task(_one(*item)))
+
+        try:
+            _fill()
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.discard(task)
+                    yield task.result()
+                _fill()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def generate_many(self, jobs: Iterable[Job]) -> list[JobResult]:
+        """并发提交多个任务，按输入顺序返回全部结果"""
+        jobs = list(jobs)
+        results: list[JobResult | None] = [None] * len(jobs)
+        async for index, item in self._iter_indexed(enumerate(jobs)):
+            results[index] = item
+        return results
+
+    async def generate_all_features(
+        self,
+        images: Images,
+        features: Sequence[str] = FEATURES,
+    ) -> dict[str, JobResult]:
+        """用同一组图片并发生成多个功能，返回 {功能: JobResult}"""
+        results = await self.generate_many(Job(feature, images, tag=feature) for feature in features)
+        return {item.job.feature: item for item in results}
+
+
+def _detail(resp: httpx.Response) -> Any:
+    try:
+        return resp.json().get("detail")
+    except (ValueError, AttributeError):
+        return (resp.text or "")[:500]
@@ -0,0 +1,124 @@
+import asyncio
+import io
+import json
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import bulk
+from app.services.MCPP_fork_main import ServiceError
+from app.services.scheduler import FairScheduler
+from app.utils import deadline as deadline_module
+
+
+def _zip(files: dict[str, bytes]) -> zipfile.ZipFile:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    buf.seek(0)
+    return zipfile.ZipFile(buf)
+
+
+def _sku_files(sku: str, content: bytes = b"x") -> dict[str, bytes]:
+    return {f"{sku}/{name}.png": content + name.encode() for name in ("纸巾", "6寸餐盘", "9寸餐盘", "刀叉")}
+
+
+def _manifest(*lines) -> dict[str, bytes]:
+    files = {f"img/{i}.png": b"x" for i in range(1, 5)}
+    files[bulk.MANIFEST_NAME] = "\n".join(
+        line if isinstance(line, str) else json.dumps(line, ensure_ascii=False) for line in lines
+    ).encode("utf-8")
+    return files
+
+
+def test_scan_archive_by_directory():
+    files = {**_sku_files("A001"), **_sku_files("A002"), "A003/纸巾.png": b"x", "readme.txt": b""}
+    sets = bulk.scan_archive(_zip(files))
+    # A003 缺少图片被跳过，根目录文件被忽略
+    assert [sku for sku, _ in sets] == ["A001", "A002"]
+    assert sets[0][1] == {
+        "image1": "A001/纸巾.png", "image2": "A001/6寸餐盘.png",
+        "image3": "A001/9寸餐盘.png", "image4": "A001/刀叉.png",
+    }
+
+
+def test_scan_archive_manifest():
+    entry = {"sku": "A001", **{f"image{i}": f"img/{i}.png" for i in range(1, 5)}}
+    sets = bulk.scan_archive(_zip(_manifest(entry, "")))
+    assert sets == [("A001", {f"image{i}": f"img/{i}.png" for i in range(1, 5)})]
+
+
+@pytest.mark.parametrize("line", [
+    "not json",
+    ["A001", "img/1.png"],
+    "42",
+    {"image1": "img/1.png", "image2": "img/2.png", "image3": "img/3.png", "image4": "img/4.png"},
+    {"sku": "A001", "image1": ["img/1.png"], "image2": "img/2.png", "image3": "img/3.png", "image4": "img/4.png"},
+    {"sku": "A001", "image1": "img/1.png", "image2": "img/2.png", "image3": "img/3.png", "image4": "missing.png"},
+])
+def test_scan_archive_rejects_invalid_manifest_lines(line):
+    with pytest.raises(ServiceError):
+        bulk.scan_archive(_zip(_manifest(line)))
+
+
+@pytest.fixture
+def runner(monkeypatch, tmp_path):
+    calls = []
+
+    async def fake_run(images, feature=None, deadline=None, tenant=None, **kwargs):
+        contents = [await images[slot].read() for slot in bulk.SLOTS]
+        calls.append((tenant, feature, contents[0]))
+        return {"status": "success", "output": f"out-{len(calls)}", "mode": "sync"}
+
+    scheduler = FairScheduler(capacity=4, batch_capacity=4, tenant_cap=4)
+    monkeypatch.setattr(bulk, "main_run", fake_run)
+    monkeypatch.setattr(bulk, "get_scheduler", lambda: scheduler)
+    monkeypatch.setattr(bulk, "get_settings", lambda: SimpleNamespace(DATA_DIR=str(tmp_path), BULK_CONCURRENCY=2))
+    monkeypatch.setattr(
+        deadline_module, "get_settings",
+        lambda: SimpleNamespace(REQUEST_TIMEOUT_SECONDS=60.0, REQUEST_TIMEOUT_MAX_SECONDS=60.0),
+    )
+
+    def _run(archive, tenant, job_id="job1"):
+        async def main():
+            sets = bulk.scan_archive(archive)
+            return [line async for line in bulk.iter_bulk_results(archive, sets, ["商品主图"], job_id, tenant)]
+
+        return asyncio.run(main())
+
+    _run.calls = calls
+    _run.root = tmp_path
+    return _run
+
+
+def test_resume_is_scoped_by_tenant_and_content(runner):
+    files = {**_sku_files("A001"), **_sku_files("A002")}
+
+    first = runner(_zip(files), "shop-a")
+    assert [line.get("status") for line in first] == ["success", "success", "done"]
+    assert len(runner.calls) == 2
+    assert all("digest" not in line for line in first)
+
+    # 同一租户、同一 job_id、图片未变：全部复用
+    again = runner(_zip(files), "shop-a")
+    assert [line.get("resumed") for line in again[:2]] == [True, True]
+    assert len(runner.calls) == 2
+    assert all("digest" not in line for line in again)
+
+    # 其他租户使用相同 job_id 不会拿到 shop-a 的结果
+    other = runner(_zip(files), "shop-b")
+    assert not any(line.get("resumed") for line in other)
+    assert len(runner.calls) == 4
+
+    # A002 的图片变化后重新生成，A001 仍复用
+    changed = {**files, **_sku_files("A002", b"y")}
+    lines = {line["sku"]: line for line in runner(_zip(changed), "shop-a") if "sku" in line}
+    assert lines["A001"].get("resumed") and not lines["A002"].get("resumed")
+    assert len(runner.calls) == 5
+
+    # 状态文件不在 MEDIA_ROOT 中，且路径不含租户标识
+    paths = list(runner.root.rglob("*.jsonl"))
+    assert len(paths) == 2
+    assert not any("shop" in str(p.relative_to(runner.root)) for p in paths)
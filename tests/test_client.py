@@ -0,0 +1,72 @@
+import asyncio
+
+import httpx
+import pytest
+
+from mcpp_client import AsyncMCPPClient, Job, MCPPError
+
+IMAGES = [b"1", b"2", b"3", b"4"]
+
+
+def _run(responses: list) -> tuple[object, list]:
+    """按顺序返回 responses（状态码或异常），返回 (结果或异常, 收到的请求)"""
+    seen = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        item = responses[min(len(seen), len(responses)) - 1]
+        if isinstance(item, Exception):
+            raise item
+        return httpx.Response(item, json={"status": "success", "output": "x.png", "mode": "sync"})
+
+    async def main():
+        client = AsyncMCPPClient("http://test", max_retries=3, backoff_base=0, backoff_max=0)
+        client._http = httpx.AsyncClient(base_url="http://test", transport=httpx.MockTransport(handler))
+        async with client:
+            try:
+                return await client.generate("product_main", IMAGES)
+            except MCPPError as e:
+                return e
+
+    return asyncio.run(main()), seen
+
+
+def test_retries_gateway_errors_with_same_key():
+    result, seen = _run([503, 502, 200])
+    assert result["output"] == "x.png"
+    assert len(seen) == 3
+    assert len({r.headers["idempotency-key"] for r in seen}) == 1
+
+
+@pytest.mark.parametrize("status", [500, 504])
+def test_does_not_retry_server_failures(status):
+    result, seen = _run([status, 200])
+    assert isinstance(result, MCPPError) and result.status_code == status
+    assert len(seen) == 1
+
+
+def test_retries_connect_errors_only():
+    result, seen = _run([httpx.ConnectError("refused"), 200])
+    assert result["output"] == "x.png"
+    assert len(seen) == 2
+
+    result, seen = _run([httpx.ReadTimeout("slow"), 200])
+    assert isinstance(result, MCPPError)
+    assert len(seen) == 1
+
+
+def test_generate_many_keeps_duplicate_jobs():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, json={"status": "success", "output": "x.png", "mode": "sync"})
+
+    async def main():
+        client = AsyncMCPPClient("http://test", max_concurrency=2)
+        client._http = httpx.AsyncClient(base_url="http://test", transport=httpx.MockTransport(handler))
+        job = Job("product_main", IMAGES)
+        async with client:
+            return job, await client.generate_many([job, Job("product_size", IMAGES), job])
+
+    job, results = asyncio.run(main())
+    assert [r.job.feature for r in results] == ["product_main", "product_size", "product_main"]
+    assert results[0].job is job and results[2].job is job
+    assert all(r.ok for r in results)
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.utils import deadline as deadline_module
+from app.utils import http
+from app.utils.deadline import ClientDisconnected, Deadline, DeadlineCancelled, DeadlineExceeded, run_with_deadline
+
+
+class _Request:
+    def __init__(self, headers=None, disconnect_after: float | None = None):
+        self.headers = headers or {}
+        self._disconnect_at = None if disconnect_after is None else time.monotonic() + disconnect_after
+
+    async def is_disconnected(self) -> bool:
+        return self._disconnect_at is not None and time.monotonic() >= self._disconnect_at
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    values = SimpleNamespace(REQUEST_TIMEOUT_SECONDS=180.0, REQUEST_TIMEOUT_MAX_SECONDS=600.0)
+    monkeypatch.setattr(deadline_module, "get_settings", lambda: values)
+    return values
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("30", 30.0),
+    ("-5", 180.0),
+    ("0", 180.0),
+    ("nan", 180.0),
+    ("inf", 180.0),
+    ("abc", 180.0),
+    ("9999", 600.0),
+])
+def test_from_request_clamps_header(settings, raw, expected):
+    assert Deadline.from_request(_Request({"x-request-timeout": raw})).timeout_seconds == expected
+
+
+def test_from_request_default(settings):
+    assert Deadline.from_request(None).timeout_seconds == 180.0
+
+
+def test_check_raises_dedicated_errors():
+    d = Deadline(60)
+    d.check()
+    d.cancel()
+    with pytest.raises(DeadlineCancelled):
+        d.check()
+    with pytest.raises(DeadlineExceeded):
+        Deadline(0).check()
+
+
+def test_run_with_deadline_timeout_cancels_work():
+    async def main():
+        d = Deadline(0.05)
+        started = asyncio.Event()
+        cancelled = []
+
+        async def work():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        with pytest.raises(DeadlineExceeded):
+            await run_with_deadline(work(), d, poll_interval=0.01)
+        assert started.is_set() and cancelled == [True]
+        assert d.cancelled
+
+    asyncio.run(main())
+
+
+def test_run_with_deadline_disconnect():
+    async def main():
+        d = Deadline(10)
+        with pytest.raises(ClientDisconnected):
+            await run_with_deadline(asyncio.sleep(10), d, request=_Request(disconnect_after=0.05), poll_interval=0.01)
+        assert d.cancelled and not d.expired
+
+    asyncio.run(main())
+
+
+def test_run_with_deadline_returns_result():
+    async def main():
+        async def work():
+            return {"status": "success"}
+
+        assert await run_with_deadline(work(), Deadline(10), request=_Request(), poll_interval=0.01) == {
+            "status": "success"
+        }
+
+    asyncio.run(main())
+
+
+def test_wait_for_outputs_stops_on_cancel_event(monkeypatch):
+    polls = []
+
+    def pending(url, api_key=None, timeout=60):
+        polls.append(url)
+        return {"data": {"status": "processing", "outputs": []}}
+
+    monkeypatch.setattr(http, "get_json", pending)
+    event = threading.Event()
+    outcome = {}
+
+    def _poll():
+        try:
+            http.wait_for_outputs("http://upstream/result", api_key="k", timeout_seconds=60,
+                                  poll_interval=5.0, cancel_event=event)
+        except http.APIRequestError as e:
+            outcome["error"] = str(e)
+
+    worker = threading.Thread(target=_poll)
+    worker.start()
+    time.sleep(0.1)
+    started = time.monotonic()
+    event.set()
+    worker.join(timeout=2)
+    assert not worker.is_alive()
+    assert time.monotonic() - started < 1
+    assert outcome["error"] == "Polling cancelled"
+    assert len(polls) == 1
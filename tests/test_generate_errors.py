@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import MCPP_fork_main
+from app.services.MCPP_fork_main import ServiceError, TransientServiceError
+from app.services.idempotency import IdempotencyStore
+from app.utils.deadline import Deadline
+from app.utils.http import APIRequestError
+from app.utils.memprof import NULL_PROFILE
+
+
+def _generate(monkeypatch, error: Exception) -> tuple[Exception, int]:
+    calls = []
+
+    def failing_post_edit(**kwargs):
+        calls.append(1)
+        raise error
+
+    monkeypatch.setattr(MCPP_fork_main, "post_edit", failing_post_edit)
+    monkeypatch.setattr(MCPP_fork_main, "get_settings", lambda: SimpleNamespace(API_URL="http://upstream", API_KEY="k"))
+
+    async def main():
+        store = IdempotencyStore(
+            ttl_seconds=60, final_errors=(ServiceError,), transient_errors=(TransientServiceError,)
+        )
+
+        async def work():
+            return await MCPP_fork_main._generate("prompt", ["data:"], "商品主图", "1k", Deadline(30), NULL_PROFILE)
+
+        for _ in range(2):
+            with pytest.raises(ServiceError) as info:
+                await store.run("k", "fp", work)
+        return info.value
+
+    return asyncio.run(main()), len(calls)
+
+
+def test_upstream_5xx_is_not_stored(monkeypatch):
+    error, calls = _generate(monkeypatch, APIRequestError("Upstream API returned 503", status_code=503))
+    assert isinstance(error, TransientServiceError)
+    assert calls == 2
+
+
+def test_network_error_is_not_stored(monkeypatch):
+    error, calls = _generate(monkeypatch, APIRequestError("Network error: reset"))
+    assert isinstance(error, TransientServiceError)
+    assert calls == 2
+
+
+def test_upstream_rejection_is_stored(monkeypatch):
+    error, calls = _generate(monkeypatch, APIRequestError("Upstream API returned 400", status_code=400))
+    assert not isinstance(error, TransientServiceError)
+    assert calls == 1
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+
+from app.services.idempotency import IdempotencyConflict, IdempotencyStore
+
+
+class Rejected(Exception):
+    pass
+
+
+def _store() -> IdempotencyStore:
+    return IdempotencyStore(ttl_seconds=60, final_errors=(Rejected,))
+
+
+def test_disconnected_caller_does_not_cancel_generation():
+    # 客户端超时断开后重试：第一次的生成继续进行，重试拿到同一个结果，上游只调用一次
+    async def main():
+        store = _store()
+        calls = []
+        release = asyncio.Event()
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            return {"status": "success", "output": "a.png"}
+
+        first = asyncio.create_task(store.run("k", "fp", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+        retry = asyncio.create_task(store.run("k", "fp", work))
+        await asyncio.sleep(0)
+        release.set()
+        assert await retry == {"status": "success", "output": "a.png"}
+        assert await store.run("k", "fp", work) == {"status": "success", "output": "a.png"}
+        assert len(calls) == 1
+
+    asyncio.run(main())
+
+
+def test_final_error_is_stored():
+    async def main():
+        store = _store()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            raise Rejected("bad input")
+
+        for _ in range(2):
+            with pytest.raises(Rejected):
+                await store.run("k", "fp", work)
+        assert len(calls) == 1
+
+    asyncio.run(main())
+
+
+def test_transient_failure_lets_waiting_retry_take_over():
+    async def main():
+        store = _store()
+        calls = []
+        release = asyncio.Event()
+
+        async def work():
+            calls.append(1)
+            if len(calls) == 1:
+                await release.wait()
+                raise RuntimeError("upstream crashed")
+            return {"status": "success", "output": "b.png"}
+
+        first = asyncio.create_task(store.run("k", "fp", work))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(store.run("k", "fp", work))
+        await asyncio.sleep(0)
+        release.set()
+
+        with pytest.raises(RuntimeError):
+            await first
+        assert await waiter == {"status": "success", "output": "b.png"}
+        assert len(calls) == 2
+
+    asyncio.run(main())
+
+
+def test_conflicting_payload():
+    async def main():
+        store = _store()
+
+        async def work():
+            return {"status": "success", "output": "a.png"}
+
+        await store.run("k", "fp", work)
+        with pytest.raises(IdempotencyConflict):
+            await store.run("k", "other", work)
+
+    asyncio.run(main())
+
+
+def test_transient_subclass_is_not_stored_and_final_error_drops_task():
+    class Transient(Rejected):
+        pass
+
+    async def main():
+        store = IdempotencyStore(ttl_seconds=60, final_errors=(Rejected,), transient_errors=(Transient,))
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            raise Transient("upstream 503")
+
+        for _ in range(2):
+            with pytest.raises(Transient):
+                await store.run("k", "fp", flaky)
+        assert len(calls) == 2
+
+        async def rejected():
+            raise Rejected("bad input")
+
+        with pytest.raises(Rejected):
+            await store.run("r", "fp", rejected)
+        await asyncio.sleep(0)
+        entry = store._entries["r"]
+        # 保存的只有不带 traceback 的异常，不再持有任务及其栈帧
+        assert entry.task is None
+        assert entry.error.__traceback__ is None and entry.error.__context__ is None
+        with pytest.raises(Rejected, match="bad input"):
+            await store.run("r", "fp", rejected)
+
+    asyncio.run(main())
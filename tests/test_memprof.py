@@ -0,0 +1,33 @@
+import asyncio
+import tracemalloc
+
+from app.utils.memprof import MemoryProfiler
+
+
+def test_stage_peaks_and_captured_allocations():
+    async def main():
+        profiler = MemoryProfiler(sample_rate=1.0, top_n=5)
+        profiler.configure(enabled=True)
+        try:
+            profile = profiler.start("商品主图")
+            await profile.begin()
+            with profile.stage("encode"):
+                buffers = [bytearray(1 << 20) for _ in range(4)]
+            await profile.capture("encode")
+            del buffers
+            profile.finish()
+        finally:
+            profiler.configure(enabled=False)
+
+        recent = profiler.report()["recent"][-1]
+        (stage,) = recent["stages"]
+        assert stage["stage"] == "encode"
+        assert stage["peak_bytes"] >= 4 << 20
+        # 快照只在 begin/capture 中获取，阶段记录本身不含分配位置
+        assert "top_allocations" not in stage
+        top = recent["top_allocations"]["encode"][0]
+        assert top["size_diff_bytes"] >= 4 << 20
+        assert "test_memprof.py" in top["site"]
+        assert not tracemalloc.is_tracing()
+
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+import io
+
+from PIL import Image, ImageDraw
+
+from app.services.phash_index import HASH_BITS, PerceptualIndex, combine_signatures, image_signature
+
+SCOPE = ("shop-a", "商品主图", "1k")
+
+
+def _dots(color: tuple[int, int, int], fmt: str = "PNG", quality: int = 95) -> bytes:
+    img = Image.new("RGB", (256, 256), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(16, 256, 48):
+        for x in range(16, 256, 48):
+            draw.ellipse((x, y, x + 24, y + 24), fill=color)
+    buf = io.BytesIO()
+    img.save(buf, fmt, quality=quality)
+    return buf.getvalue()
+
+
+def _index(*sets: list[bytes]) -> PerceptualIndex:
+    index = PerceptualIndex(max_distance=12, max_image_distance=6, max_color_diff=24)
+    for i, images in enumerate(sets):
+        value, colors = combine_signatures([image_signature(c) for c in images])
+        index.add(SCOPE, value, HASH_BITS * len(images), colors, f"out-{i}")
+    return index
+
+
+def _lookup(index: PerceptualIndex, images: list[bytes], scope: tuple = SCOPE):
+    value, colors = combine_signatures([image_signature(c) for c in images])
+    return index.lookup(scope, value, HASH_BITS * len(images), colors)
+
+
+def test_recompressed_upload_hits():
+    index = _index([_dots((255, 105, 180))] * 4)
+    match = _lookup(index, [_dots((255, 105, 180), "JPEG", quality=70)] * 4)
+    assert match is not None and match[0] == "out-0"
+
+
+def test_colorway_variant_misses():
+    # 同一图案换配色时 dHash 相同，必须靠色块区分
+    pink, navy = _dots((255, 105, 180)), _dots((0, 0, 128))
+    assert image_signature(pink)[0] == image_signature(navy)[0]
+    index = _index([pink] * 4)
+    assert _lookup(index, [navy] * 4) is None
+
+
+def test_distance_limit_applies_per_image():
+    # 整组只差 10 位（不超过 12），但全部集中在一张图片上
+    index = PerceptualIndex(max_distance=12, max_image_distance=6, max_color_diff=24)
+    colors = bytes(48 * 4)
+    index.add(SCOPE, 0, HASH_BITS * 4, colors, "out")
+    assert index.lookup(SCOPE, (1 << 10) - 1, HASH_BITS * 4, colors) is None
+    spread = 0b111 | (0b111 << 64) | (0b1111 << 128)
+    assert index.lookup(SCOPE, spread, HASH_BITS * 4, colors) == ("out", 10)
+
+
+def test_scope_isolates_tenants_and_resolutions():
+    pink = _dots((255, 105, 180))
+    index = _index([pink] * 4)
+    assert _lookup(index, [pink] * 4, ("shop-b", "商品主图", "1k")) is None
+    assert _lookup(index, [pink] * 4, ("shop-a", "商品主图", "2k")) is None
+
+
+def test_index_file_round_trip_without_raw_tenant(tmp_path):
+    path = tmp_path / "phash_index.jsonl"
+    index = PerceptualIndex(max_distance=12, path=path)
+    colors = bytes(48 * 4)
+    index.add(SCOPE, 123, HASH_BITS * 4, colors, "out")
+    assert "shop-a" not in path.read_text(encoding="utf-8")
+
+    reloaded = PerceptualIndex(max_distance=12, path=path)
+    assert reloaded.load() == 1
+    assert reloaded.lookup(SCOPE, 123, HASH_BITS * 4, colors) == ("out", 0)
+    assert reloaded.lookup(("shop-b", "商品主图", "1k"), 123, HASH_BITS * 4, colors) is None
@@ -0,0 +1,47 @@
+import pytest
+
+from app.utils.polling import CompletionStats, plan_polls, reported_duration
+
+
+def test_fixed_interval_until_enough_samples():
+    stats = CompletionStats()
+    for _ in range(4):
+        stats.record("f", 60.0)
+    offsets = plan_polls(stats, "f", timeout_seconds=180, budget=40, min_samples=5)
+    assert offsets[:3] == [1.0, 2.0, 3.0]
+    assert offsets[-1] == 180
+    assert all(b - a == 1.0 for a, b in zip(offsets, offsets[1:]))
+
+
+def test_probes_before_earliest_sample():
+    # 历史耗时 60~90 秒时仍要在更早的时刻探测，上游变快后才能记录到更短的耗时
+    stats = CompletionStats()
+    for i in range(30):
+        stats.record("f", 60.0 + i)
+    offsets = plan_polls(stats, "f", timeout_seconds=180, budget=40, min_samples=5)
+    assert len(offsets) <= 40
+    assert offsets == sorted(offsets)
+    assert offsets[0] < 5
+    assert any(20 <= t < 60 for t in offsets)
+    assert offsets[-1] == 180
+
+
+def test_reported_duration():
+    assert reported_duration({
+        "created_at": "2024-01-01T00:00:00Z",
+        "completed_at": "2024-01-01T00:00:21.5Z",
+    }) == 21.5
+    assert reported_duration({"timings": {"inference": 1500}}) == 1.5
+    assert reported_duration({"status": "completed"}) is None
+    assert reported_duration(None) is None
+
+
+@pytest.mark.parametrize("budget", [1, 2, 3, 4, 5, 8, 40])
+def test_small_budgets_still_reach_timeout(budget):
+    stats = CompletionStats()
+    for i in range(20):
+        stats.record("f", 10.0 + i * 0.2)
+    offsets = plan_polls(stats, "f", timeout_seconds=180, budget=budget, min_samples=5)
+    assert 1 <= len(offsets) <= budget
+    assert offsets == sorted(offsets)
+    assert offsets[-1] == 180
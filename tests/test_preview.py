@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.services import MCPP_fork_main
+from app.services.scheduler import FairScheduler
+from app.utils.deadline import Deadline
+
+
+def _settings(**overrides):
+    values = {
+        "DEFAULT_RESOLUTION": "1k",
+        "FEATURE_RESOLUTIONS": {},
+        "PREVIEW_FEATURES": ["product_main"],
+        "PREVIEW_RESOLUTION": "1k",
+    }
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+
+def test_preview_skipped_when_not_cheaper(monkeypatch):
+    monkeypatch.setattr(MCPP_fork_main, "get_settings", lambda: _settings())
+    assert not MCPP_fork_main.preview_enabled("商品主图")
+
+
+def test_preview_enabled_below_full_resolution(monkeypatch):
+    monkeypatch.setattr(
+        MCPP_fork_main, "get_settings", lambda: _settings(FEATURE_RESOLUTIONS={"product_main": "2k"})
+    )
+    assert MCPP_fork_main.preview_enabled("商品主图")
+    assert not MCPP_fork_main.preview_enabled("商品尺寸图")
+
+
+def test_preview_skipped_without_free_slot(monkeypatch):
+    scheduler = FairScheduler(capacity=4, batch_capacity=4, tenant_cap=1)
+    calls = []
+
+    async def fake_generate(*args, **kwargs):
+        calls.append(scheduler.stats()["running_by_tenant"])
+        return {"status": "success", "output": "p.jpg", "mode": "sync"}
+
+    monkeypatch.setattr(MCPP_fork_main, "get_scheduler", lambda: scheduler)
+    monkeypatch.setattr(MCPP_fork_main, "_generate", fake_generate)
+    monkeypatch.setattr(MCPP_fork_main, "get_settings", lambda: _settings())
+
+    async def main():
+        previews = []
+        await MCPP_fork_main._run_preview("p", [], "商品主图", Deadline(10), previews.append, "shop-a")
+        # 预览占用该租户自己的槽位
+        assert calls == [{"shop-a": 1}] and previews[0]["status"] == "preview"
+
+        async with scheduler.slot("shop-a"):
+            await MCPP_fork_main._run_preview("p", [], "商品主图", Deadline(10), previews.append, "shop-a")
+        assert len(calls) == 1 and len(previews) == 1
+
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+import asyncio
+import importlib
+import json
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.services.MCPP_fork_main import ServiceError
+from app.services.scheduler import FairScheduler
+from app.utils import deadline as deadline_module
+
+FILES = {f"image{i}": (f"{i}.png", b"x", "image/png") for i in range(1, 5)}
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setenv("MEDIA_ROOT", str(tmp_path))
+    main = importlib.import_module("app.main")
+    monkeypatch.setattr(main, "get_scheduler", lambda: FairScheduler(capacity=2, batch_capacity=2, tenant_cap=2))
+    monkeypatch.setattr(
+        deadline_module, "get_settings",
+        lambda: SimpleNamespace(
+            REQUEST_TIMEOUT_SECONDS=10.0, REQUEST_TIMEOUT_MAX_SECONDS=10.0, DISCONNECT_POLL_INTERVAL=0.01,
+        ),
+    )
+
+    def _client(fail: bool = False) -> TestClient:
+        async def fake_run(images, request=None, feature=None, deadline=None, on_preview=None, tenant=None):
+            assert on_preview is not None
+            on_preview({"status": "preview", "output": "preview.jpg", "mode": "sync"})
+            await asyncio.sleep(0.05)
+            if fail:
+                raise ServiceError("上游拒绝请求 (400)")
+            return {"status": "success", "output": "final.jpg", "mode": "sync"}
+
+        monkeypatch.setattr(main, "main_run", fake_run)
+        return TestClient(main.app)
+
+    return _client
+
+
+def _lines(response) -> list[dict]:
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    return [json.loads(line) for line in response.text.splitlines() if line]
+
+
+def test_progressive_preview_then_final(client):
+    response = client().post("/generate/product_main?progressive=true", files=FILES)
+    lines = _lines(response)
+    assert [line["status"] for line in lines] == ["preview", "success"]
+    assert lines[-1]["output"] == "final.jpg"
+
+
+def test_progressive_error_is_last_line(client):
+    response = client(fail=True).post("/generate/product_main?progressive=true", files=FILES)
+    lines = _lines(response)
+    assert [line["status"] for line in lines] == ["preview", "error"]
+    assert lines[-1]["code"] == 400
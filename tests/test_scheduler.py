@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from app.services.scheduler import BATCH, INTERACTIVE, FairScheduler, api_key_tenant, resolve_tenant
+
+
+async def _hold(scheduler: FairScheduler, tenant: str, priority: str, order: list, release: asyncio.Event):
+    async with scheduler.slot(tenant, priority):
+        order.append(tenant)
+        await release.wait()
+
+
+async def _tick(n: int = 3) -> None:
+    for _ in range(n):
+        await asyncio.sleep(0)
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    # 同一轮事件循环内释放槽位并取消排队请求：被取消的 future 不能被分配槽位
+    async def main():
+        scheduler = FairScheduler(capacity=1, batch_capacity=1, tenant_cap=1)
+        release = asyncio.Event()
+        holder = asyncio.create_task(_hold(scheduler, "a", INTERACTIVE, [], release))
+        await _tick()
+        waiter = asyncio.create_task(_hold(scheduler, "b", INTERACTIVE, [], asyncio.Event()))
+        await _tick()
+
+        release.set()
+        waiter.cancel()
+        await holder
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        assert scheduler.stats()["running"] == 0
+        assert scheduler.stats()["running_by_tenant"] == {}
+
+        async def _again():
+            async with scheduler.slot("b"):
+                return True
+
+        assert await asyncio.wait_for(_again(), timeout=1)
+
+    asyncio.run(main())
+
+
+def test_interactive_before_batch_and_batch_cap():
+    async def main():
+        scheduler = FairScheduler(capacity=2, batch_capacity=1, tenant_cap=4)
+        order: list = []
+        release = asyncio.Event()
+        tasks = [
+            asyncio.create_task(_hold(scheduler, "bulk", BATCH, order, release)),
+            asyncio.create_task(_hold(scheduler, "bulk", BATCH, order, release)),
+        ]
+        await _tick()
+        # 批量任务最多占 1 个槽位，剩下的留给交互请求
+        assert order == ["bulk"]
+        tasks.append(asyncio.create_task(_hold(scheduler, "shop", INTERACTIVE, order, release)))
+        await _tick()
+        assert order == ["bulk", "shop"]
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())
+
+
+def test_weighted_share_between_tenants():
+    async def main():
+        scheduler = FairScheduler(capacity=1, batch_capacity=1, tenant_cap=1, weights={"a": 2})
+        order: list = []
+
+        async def _one(tenant: str):
+            async with scheduler.slot(tenant):
+                order.append(tenant)
+                await asyncio.sleep(0)
+
+        blocker = asyncio.Event()
+        first = asyncio.create_task(_hold(scheduler, "x", INTERACTIVE, [], blocker))
+        await _tick()
+        tasks = [asyncio.create_task(_one(t)) for t in ["a"] * 4 + ["b"] * 2]
+        await _tick()
+        blocker.set()
+        await asyncio.gather(first, *tasks)
+        # 权重 2:1，前三个槽位中 a 占两个
+        assert order[:3].count("a") == 2
+        assert sorted(order) == ["a"] * 4 + ["b"] * 2
+
+    asyncio.run(main())
+
+
+def test_tenant_from_api_key_is_not_the_secret():
+    class _Request:
+        def __init__(self, headers):
+            self.headers = headers
+
+    tenant, priority = resolve_tenant(_Request({"x-api-key": "sk-secret", "x-priority": "batch"}))
+    assert tenant == api_key_tenant("sk-secret")
+    assert "sk-secret" not in tenant and tenant.startswith("key-")
+    assert priority == BATCH
+    assert resolve_tenant(_Request({"x-tenant-id": "shop-a", "x-api-key": "sk-secret"}))[0] == "shop-a"
+    assert resolve_tenant(_Request({}))[0] == "anonymous"
+
+
+def test_try_slot_counts_against_tenant_and_never_queues():
+    async def main():
+        scheduler = FairScheduler(capacity=4, batch_capacity=4, tenant_cap=2)
+        release = asyncio.Event()
+        holder = asyncio.create_task(_hold(scheduler, "a", INTERACTIVE, [], release))
+        await _tick()
+
+        with scheduler.try_slot("a") as acquired:
+            assert acquired
+            assert scheduler.stats()["running_by_tenant"] == {"a": 2}
+            # 租户已达上限：不排队，直接放弃
+            with scheduler.try_slot("a") as again:
+                assert not again
+        assert scheduler.stats()["running_by_tenant"] == {"a": 1}
+
+        release.set()
+        await holder
+        assert scheduler.stats()["running"] == 0
+
+    asyncio.run(main())